@@ -20,11 +20,21 @@ def main():
     parser = argparse.ArgumentParser(
         description='SEN3R (Sentinel-3 Reflectance Retrieval over Rivers) '
                     'enables extraction of reflectance time series from Sentinel-3 L2 WFR images over water bodies.')
-    parser.add_argument("-i", "--input", help="The products input folder. Required.", type=str)
+    parser.add_argument("-i", "--input", help="The products input folder, with .SEN3 folders and/or zipped .SEN3 "
+                                              "products. Required.", type=str)
     parser.add_argument("-o", "--out", help="Output directory. Required.", type=str)
-    parser.add_argument("-r", "--roi", help="Region of interest (SHP, KML or GeoJSON). Required", type=str)
+    parser.add_argument("-r", "--roi", help="Region(s) of interest (SHP, KML or GeoJSON). Several ROIs are extracted "
+                                            "in a single pass over the products, each one into OUTPUT/<roi name>. "
+                                            "Required", type=str, nargs='+')
     parser.add_argument("-p", "--product", help='Currently only WFR is available.', default='WFR', type=str)
     parser.add_argument("-c", "--cams", help="Path to search for auxiliary CAMS file. Optional.", type=str)
+    parser.add_argument("--cams-match", help="How to match the CAMS records to the images: 'noon' (record of 12:00 of "
+                                             "the acquisition day), 'nearest' (record closest to the acquisition time) "
+                                             "or 'interpolate' (between the records around it). Optional. "
+                                             "Default = noon", default='noon', choices=['noon', 'nearest', 'interpolate'])
+    parser.add_argument("--cams-tolerance", help="Maximum time between an image and its CAMS records, e.g. 3h or 1D. "
+                                                 "Optional. Default = exact match for noon, no limit for nearest "
+                                                 "and interpolate", type=str)
     parser.add_argument("-min", "--irmin", help="Bottom threshold for IR. Optional. Default = 0.0", default=0.0,
                         type=float)
     parser.add_argument("-max", "--irmax", help="Upper threshold for IR. Optional. Default = 0.2", default=0.2,
@@ -32,6 +42,40 @@ def main():
     parser.add_argument("-aot", "--aotmax", help="Upper limit for AoT. Optional. Default = 0.6", default=0.6,
                         type=float)
     parser.add_argument("-k", "--cluster", help="Which method to use for clustering. Optional.", default='M4', type=str)
+    parser.add_argument("--cache", help="Folder to cache the ROI geolocation of each product, so reprocessing "
+                                        "runs can skip it. Optional.", type=str)
+    parser.add_argument("--cache-size", help="Maximum size of the --cache folder in MB. Optional. Default = 1024",
+                        default=1024, type=float)
+    parser.add_argument("--band-reader", help="How to read the NetCDF bands: 'process' (process pool) or 'thread' "
+                                              "(in-process thread pool reusing open files; the NetCDF library is "
+                                              "not thread-safe, so it reads and decompresses one band at a time). "
+                                              "Optional. Default = process", default='process',
+                        choices=['thread', 'process'])
+    parser.add_argument("--workers", help="Number of workers in the pool shared by the whole run. Optional. "
+                                          "Default = available CPU cores - 1", type=int)
+    parser.add_argument("--products-in-flight", help="Number of products extracted at the same time, each one in "
+                                                     "its own process. Optional. Default = 1", default=1, type=int)
+    parser.add_argument("--max-memory", help="Memory budget of the run in MB. Products and band reads are only "
+                                             "started while their estimated footprint fits in it. Optional. "
+                                             "Default = 80%% of the container/system available memory", type=float)
+    parser.add_argument("--rgb-max-size", help="Decimate the RGB quicklooks so their largest side has at most this "
+                                               "many pixels. Optional.", type=int)
+    parser.add_argument("--unzip-dir", help="Folder for the files taken out of zipped products, removed after each "
+                                            "product. Optional. Default = system temporary folder", type=str)
+    parser.add_argument("--pushdown", help="Read the WQSF, Oa08 and Oa01 bands first and gather the other bands only "
+                                           "at the pixels passing the nodata, saturation and WQSF filters. "
+                                           "Optional.", action='store_true')
+    parser.add_argument("--min-valid", help="Minimum %% of valid water pixels (WQSF) inside the ROI. Products below "
+                                            "it are skipped before reading the other bands and reported as skipped "
+                                            "in the time series. Optional.", type=float)
+    parser.add_argument("--format", help="Format of the intermediate CSV_N1/CSV_N2 pixel files: 'csv' (readable by "
+                                         "humans) or 'parquet' (float32 columns, compressed, needs pyarrow). "
+                                         "Optional. Default = csv", default='csv', choices=['csv', 'parquet'])
+    parser.add_argument("--store", help="Also append the extracted pixels to a single Parquet dataset in this folder, "
+                                        "partitioned by ROI and date (see sen3r.commons.PixelStore). Optional.",
+                        type=str)
+    parser.add_argument("--flags", help="Keep the human-readable FLAGS column (names of the WQSF flags raised) in "
+                                        "the CSV_N2 files, next to QUALITY. Optional.", action='store_true')
     parser.add_argument("-s", "--single",
                         help="Single mode: run SEN3R over only one image instead of a whole directory."
                              " Optional.", action='store_true')
@@ -83,15 +127,25 @@ def main():
         if args['single']:  # Single mode
             band_data, img_data, doneList = s3r.build_single_csv()
 
+        elif s3r.multi_roi:  # Several ROIs: extract them all at once, then process each ROI series
+            doneDict = s3r.build_raw_csvs()
+            for rname, doneList in doneDict.items():
+                s3r.process_csv_list(raw_csv_list=doneList, irmax=args['irmax'], irmin=args['irmin'],
+                                     max_aot=args['aotmax'], use_cams=bool(s3r.arguments['cams']),
+                                     k_method=s3r.arguments['cluster'], rname=rname,
+                                     flags=args['flags'])
+
         else:  # Default mode: several images
             doneList = s3r.build_raw_csvs()
             print('cams_args:', s3r.arguments['cams'])
             if s3r.arguments["cams"]:
                 s3r.process_csv_list(raw_csv_list=doneList, irmax=args['irmax'], irmin=args['irmin'],
-                                     max_aot=args['aotmax'], use_cams=True, k_method=s3r.arguments['cluster'])
+                                     max_aot=args['aotmax'], use_cams=True, k_method=s3r.arguments['cluster'],
+                                     flags=args['flags'])
             else:
                 s3r.process_csv_list(raw_csv_list=doneList, irmax=args['irmax'], irmin=args['irmin'],
-                                     max_aot=args['aotmax'], k_method=s3r.arguments['cluster'])
+                                     max_aot=args['aotmax'], k_method=s3r.arguments['cluster'],
+                                     flags=args['flags'])
 
     # ,------------------------------,
     # | End timers and report to log |----------------------------------------------------------------------------------
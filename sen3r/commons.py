@@ -2,11 +2,17 @@ import os
 import sys
 import time
 import json
+import hashlib
+import functools
+import shutil
 import logging
+import tempfile
+import threading
 import zipfile
 import subprocess
 from osgeo import ogr, osr
 import numpy as np
+import pandas as pd
 from pathlib import Path
 
 
@@ -15,6 +21,13 @@ try:
 except:
     print("Unable to import osgeo.gdal! SEN3R can still operate but some critical functions may fail.")
 
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pa_ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pa_ds = pq = None  # Only needed by the parquet intermediate files (--format parquet) and the PixelStore
+
 
 from PIL import Image
 
@@ -138,6 +151,12 @@ class DefaultDicts:
     # Pixels must include these flags:
     wfr_keep = ['INLAND_WATER']
 
+    # WQSF value for which TsGenerator.get_flags returns False
+    wfr_false_flags = 0b11111111111111111111111111111110
+
+    # Oa01_reflectance value of saturated pixels
+    wfr_oa01_saturation = 1.0000184
+
     # TODO: used in parallel only (verify).
     wfr_files_p = (('w_aer.nc', 'A865'),
                    ('w_aer.nc', 'T865'),
@@ -160,6 +179,9 @@ class DefaultDicts:
                    ('wqsf.nc', 'WQSF'),
                    ('tsm_nn.nc', 'TSM_NN'))
 
+    # Other files of a WFR product needed to geolocate the ROI, see ZippedProduct.
+    wfr_aux_files = ('geo_coordinates.nc', 'tie_geo_coordinates.nc', 'tie_geometries.nc', 'xfdumanifest.xml')
+
     syn_files = {
         'Syn_AOT550.nc': ['T550'],
         'Syn_Angstrom_exp550.nc': ['A550']
@@ -335,15 +357,79 @@ class Utils:
     def depth(somelist): return isinstance(somelist, list) and max(map(Utils.depth, somelist)) + 1
 
     def get_available_cores(self):
-        cpu_count = os.cpu_count() - 1
+        """
+        Number of cores SEN3R may use: the CPU limit of the process (see cpu_limit) minus one, between 1 and 61.
+        """
+        cpu_count = self.cpu_limit() - 1
         if cpu_count <= 0:
-            self.log.info(f'Invalid number of CPU cores available: {os.cpu_count()}.')
-            sys.exit(1)
+            log = getattr(self, 'log', logging)
+            log.info(f'Only {self.cpu_limit()} CPU core available, running with a single worker.')
+            cpu_count = 1
         elif cpu_count > 61:
             cpu_count = 61
 
         return cpu_count
 
+    @staticmethod
+    def _read_first_line(path):
+        try:
+            with open(path) as f:
+                return f.readline().strip()
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def cpu_limit():
+        """
+        Number of CPUs this process can actually run on, taking into account the CPU affinity and the
+        cgroup (v2 cpu.max or v1 cfs quota) CPU quota of the container, if any.
+        """
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = len(os.sched_getaffinity(0))
+        else:
+            cpus = os.cpu_count() or 1
+
+        quota, period = None, None
+        cpu_max = Utils._read_first_line('/sys/fs/cgroup/cpu.max')  # cgroup v2: "<quota|max> <period>"
+        if cpu_max:
+            fields = cpu_max.split()
+            if fields[0] != 'max' and len(fields) == 2:
+                quota, period = int(fields[0]), int(fields[1])
+        else:  # cgroup v1
+            cfs_quota = Utils._read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+            cfs_period = Utils._read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+            if cfs_quota and cfs_period and int(cfs_quota) > 0:
+                quota, period = int(cfs_quota), int(cfs_period)
+
+        if quota and period:
+            cpus = min(cpus, max(1, -(-quota // period)))  # ceil
+
+        return max(1, cpus)
+
+    @staticmethod
+    def memory_limit():
+        """
+        Memory available to this process in bytes: the smallest of the cgroup (v2 memory.max or
+        v1 memory.limit_in_bytes) limit of the container and the MemAvailable of /proc/meminfo.
+        Returns None when none of them can be read.
+        """
+        limits = []
+        for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+            value = Utils._read_first_line(path)
+            # cgroup v1 reports a huge number instead of 'max' when there is no limit
+            if value and value.isdigit() and int(value) < 2 ** 60:
+                limits.append(int(value))
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        limits.append(int(line.split()[1]) * 1024)
+                        break
+        except (OSError, ValueError):
+            pass
+
+        return min(limits) if limits else None
+
     @staticmethod
     def pil_grid(images, max_horiz=np.iinfo(int).max):
         """
@@ -528,6 +614,68 @@ class Utils:
             vertices.append(target_x_y)
         return np.array(vertices)
 
+    @staticmethod
+    def flag_mask(flags):
+        """
+        uint64 bitmask of a list of WQSF flag names, see DefaultDicts.wfr_bin2flags.
+        Each list of flags is only compiled once.
+        """
+        return Utils._compile_flag_mask(tuple(flags))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _compile_flag_mask(flags):
+        bits = {flag: bit for bit, flag in DefaultDicts.wfr_bin2flags.items()}
+        mask = 0
+        for flag in flags:
+            mask |= 1 << bits[flag]
+        return np.uint64(mask)
+
+    @staticmethod
+    def wqsf_quality(wqsf, keep=DefaultDicts.wfr_keep, remove=DefaultDicts.wfr_remove):
+        """
+        Vectorized equivalent of the FLAGS/QUALITY filter of TsGenerator.update_df: True where the WQSF value has every
+        keep flag, none of the remove flags and is not the value get_flags reports as False.
+        """
+        wqsf = np.asarray(wqsf).astype(np.uint64)
+        keep_mask, remove_mask = Utils.flag_mask(keep), Utils.flag_mask(remove)
+        return (((wqsf & keep_mask) == keep_mask) & ((wqsf & remove_mask) == 0) &
+                (wqsf != 0) & (wqsf != DefaultDicts.wfr_false_flags))
+
+    # Extension of the intermediate pixel files (CSV_N1/CSV_N2) of each --format
+    pixel_formats = {'csv': '.csv', 'parquet': '.parquet'}
+
+    @staticmethod
+    def write_pixels(df, path, index=False):
+        """
+        Write the pixels DataFrame df as CSV or Parquet, depending on the extension of path.
+        In Parquet (zstd compressed), the float64 columns are stored as float32, except lat/lon (':double' columns),
+        and the index is never kept.
+        """
+        if not path.endswith(Utils.pixel_formats['parquet']):
+            df.to_csv(path, index=index)
+            return path
+        narrow = {col: np.float32 for col in df.columns
+                  if df[col].dtype == np.float64 and not str(col).endswith(':double')}
+        df.astype(narrow).to_parquet(path, index=False, compression='zstd')
+        return path
+
+    @staticmethod
+    def read_pixels(path, columns=None):
+        """
+        Read a pixels file written by write_pixels. If columns is given, only those of them present in the file are
+        read (in Parquet the other columns are not even decompressed).
+        """
+        if not path.endswith(Utils.pixel_formats['parquet']):
+            if columns is None:
+                return pd.read_csv(path, sep=',')
+            wanted = set(columns)
+            return pd.read_csv(path, sep=',', usecols=lambda col: col in wanted)
+        if columns is not None:
+            names = pq.ParquetFile(path).schema_arrow.names
+            columns = [col for col in columns if col in names]
+        return pd.read_parquet(path, columns=columns)
+
     @staticmethod
     def bbox(vertices):
         """
@@ -541,6 +689,414 @@ class Utils:
         return xmin, xmax, ymin, ymax
 
 
+class GeoCache:
+    """
+    On-disk cache of the geolocation work done for a (product, ROI) pair: the x,y vertices of the polygons,
+    the rr/cc pixel indexes inside them. Entries are stored as compressed .npz files
+    and the least recently used ones are evicted once the cache grows above max_size_mb.
+    """
+
+    # Bump it whenever the content of the entries change, so old entries are never reused.
+    version = 'v2'
+
+    def __init__(self, cache_dir, max_size_mb=1024, parent_log=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.log = parent_log if parent_log else logging
+
+    @staticmethod
+    def roi_hash(vertices):
+        """
+        Hash of the ROI geometry, given as the list of lon/lat vertex arrays returned by Utils.roi2vertex.
+        """
+        sha = hashlib.sha1()
+        for vert in vertices:
+            vert = np.ascontiguousarray(vert, dtype=np.float64)
+            sha.update(str(vert.shape).encode())
+            sha.update(vert.tobytes())
+        return sha.hexdigest()
+
+    def entry_path(self, product_id, vertices):
+        return self.cache_dir / f'{product_id}_{self.version}_{self.roi_hash(vertices)}.npz'
+
+    def get(self, product_id, vertices):
+        """
+        Return a dict with the cached xy_vert, rr and cc or None if there is no entry for this product and ROI.
+        """
+        path = self.entry_path(product_id, vertices)
+        if not path.is_file():
+            return None
+        try:
+            with np.load(path) as npz:
+                xy = npz['xy']
+                splits = npz['splits']
+                entry = {'xy_vert': np.split(xy, splits) if len(xy) else [],
+                         'rr': npz['rr'],
+                         'cc': npz['cc']}
+        except (OSError, ValueError, KeyError) as e:
+            self.log.info(f'Ignoring unreadable cache entry {path}: {e}')
+            return None
+        # Mark the entry as recently used.
+        os.utime(path)
+        return entry
+
+    def put(self, product_id, vertices, xy_vert, rr, cc):
+        """
+        Store the geolocation results of a product for the given ROI vertices and evict old entries if needed.
+        """
+        xy_vert = [np.asarray(xy).reshape(-1, 2) for xy in xy_vert]
+        xy = np.concatenate(xy_vert).astype(np.int32) if xy_vert else np.empty((0, 2), dtype=np.int32)
+        path = self.entry_path(product_id, vertices)
+        # Write to a temporary file first, so a concurrent reader never sees a half written entry. Its suffix is
+        # not .npz, so the evict() of another process never deletes it before the rename.
+        tmp_path = path.with_name(path.name + f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f,
+                                xy=xy,
+                                splits=np.cumsum([len(v) for v in xy_vert])[:-1].astype(np.int64),
+                                rr=np.asarray(rr, dtype=np.int32),
+                                cc=np.asarray(cc, dtype=np.int32))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache fits into max_size.
+        """
+        entries = []
+        for f in self.cache_dir.glob('*.npz'):
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, f))
+        total = sum(size for _, size, _ in entries)
+        for _, size, f in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                f.unlink()
+                total -= size
+                self.log.info(f'Evicted cache entry: {f.name}')
+            except FileNotFoundError:
+                continue
+
+
+class PixelStore:
+    """
+    Single Parquet dataset holding the pixels of every product extracted into it, partitioned Hive-style by ROI and
+    date: store_dir/roi=<rname>/date=<YYYY-MM-DD>/<product>.parquet
+    Each product is its own file, so the store can be appended to by concurrent extractions (and reprocessed
+    products simply replace their file). read() only opens the partitions and columns it needs.
+    """
+
+    partitioning = (('roi', 'string'), ('date', 'string'))
+
+    def __init__(self, store_dir, parent_log=None):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.log = parent_log if parent_log else logging
+
+    @staticmethod
+    def to_date(value):
+        """
+        'YYYY-MM-DD' partition value of a date given as a string (e.g. 20190601T134235), date or datetime.
+        """
+        return pd.Timestamp(value).strftime('%Y-%m-%d')
+
+    def product_path(self, rname, product_id):
+        figdate = product_id.split('____')[1].split('_')[0]
+        return self.store_dir / f'roi={rname}' / f'date={self.to_date(figdate)}' / f'{product_id}.parquet'
+
+    def append(self, df, rname, product_id):
+        """
+        Store the pixels DataFrame df of product_id (file name of the product, without extension) for the ROI rname,
+        with an extra 'product' column. An empty df removes the product from the store.
+        :return: path of the written file or None if nothing was stored.
+        """
+        path = self.product_path(rname, product_id)
+        if len(df) == 0:
+            if path.exists():
+                path.unlink()
+            return None
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Hidden temporary file (ignored by the readers) first, so a reader never sees a half written product.
+        tmp_path = path.with_name('.' + path.name)
+        Utils.write_pixels(df.assign(product=product_id), str(tmp_path))
+        os.replace(tmp_path, path)
+        self.log.info(f'Stored {len(df)} pixels of {rname} at: {path}')
+        return path
+
+    def dataset(self):
+        partitioning = pa_ds.partitioning(pa.schema([(name, getattr(pa, kind)()) for name, kind in self.partitioning]),
+                                          flavor='hive')
+        return pa_ds.dataset(self.store_dir, format='parquet', partitioning=partitioning)
+
+    def read(self, rname=None, start=None, end=None, columns=None):
+        """
+        Pixels of the store as a DataFrame, optionally only those of the ROI(s) rname (str or list), dated between
+        start and end (inclusive, see to_date) and only the given columns (the partition columns roi and date can
+        be asked for too). The filters are pushed down to the partitions, the other files are never opened.
+        """
+        dataset = self.dataset()
+        expr = None
+        if rname is not None:
+            rnames = [rname] if isinstance(rname, str) else list(rname)
+            expr = pa_ds.field('roi').isin(rnames)
+        if start is not None:
+            expr = self._and(expr, pa_ds.field('date') >= self.to_date(start))
+        if end is not None:
+            expr = self._and(expr, pa_ds.field('date') <= self.to_date(end))
+        if columns is not None:
+            columns = [col for col in columns if col in dataset.schema.names]
+        return dataset.to_table(columns=columns, filter=expr).to_pandas()
+
+    @staticmethod
+    def _and(expr, other):
+        return other if expr is None else expr & other
+
+    def dates(self, rname):
+        """
+        Sorted list of the dates (YYYY-MM-DD) stored for the ROI rname.
+        """
+        roi_dir = self.store_dir / f'roi={rname}'
+        if not roi_dir.is_dir():
+            return []
+        return sorted(d.name.split('=', 1)[1] for d in roi_dir.iterdir() if d.name.startswith('date=') and
+                      any(d.glob('[!.]*.parquet')))
+
+
+class CamsTable:
+    """
+    Time series of a CAMS CSV file (Datetime and AOD865 columns), loaded once and sorted by date, so the values at
+    the acquisition dates of all the images of a run are found with a single merge_asof join (see lookup).
+    """
+
+    matches = ('noon', 'nearest', 'interpolate')
+
+    def __init__(self, cams_csv, parent_log=None):
+        self.log = parent_log if parent_log else logging
+        df = pd.read_csv(cams_csv)
+        df['pydate'] = pd.to_datetime(df['Datetime']).astype('datetime64[ns]')
+        # Sorted by date, keeping the first record of repeated dates, as the former row by row search did.
+        self.df = df.dropna(subset=['pydate']).sort_values('pydate', kind='stable').drop_duplicates('pydate')
+        self.df = self.df.reset_index(drop=True)
+        self.log.info(f'CAMS records loaded: {len(self.df)} from {cams_csv}')
+
+    def lookup(self, dates, match='noon', tolerance=None, column='AOD865'):
+        """
+        Values of column at each of the acquisition datetimes dates, matched with:
+        'noon' the record of 12:00 of the acquisition day (the daily CAMS files), 'nearest' the record closest to the
+        acquisition time, 'interpolate' the linear interpolation between the records before and after it.
+        Records further than tolerance (pandas Timedelta or string such as '3h') are ignored. By default 'noon' needs
+        an exact match and 'nearest'/'interpolate' have no limit.
+        :return: float array of the values, NaN where no record matched.
+        """
+        if match not in self.matches:
+            self.log.info(f'Invalid CAMS match: {match}. Expected one of {self.matches}.')
+            sys.exit(1)
+        if tolerance is not None:
+            tolerance = pd.Timedelta(tolerance)
+        elif match == 'noon':
+            tolerance = pd.Timedelta(0)
+        left = pd.DataFrame({'pydate': pd.to_datetime(list(dates)).astype('datetime64[ns]'),
+                             'order': np.arange(len(dates))})
+        if match == 'noon':
+            left['pydate'] = left['pydate'].dt.normalize() + pd.Timedelta(hours=12)
+        left = left.sort_values('pydate', kind='stable')
+        right = self.df[['pydate', column]].assign(cams_date=self.df['pydate'])
+
+        if match == 'interpolate':
+            before = pd.merge_asof(left, right, on='pydate', direction='backward', tolerance=tolerance)
+            after = pd.merge_asof(left, right, on='pydate', direction='forward', tolerance=tolerance)
+            span = (after['cams_date'] - before['cams_date']).dt.total_seconds().to_numpy()
+            elapsed = (left['pydate'].to_numpy() - before['cams_date'].to_numpy()) / np.timedelta64(1, 's')
+            weight = np.divide(elapsed, span, out=np.zeros(len(left)), where=span > 0)
+            values = before[column].to_numpy() + weight * (after[column].to_numpy() - before[column].to_numpy())
+            # A single record within the tolerance is used as it is
+            values = np.where(np.isnan(values), before[column].fillna(after[column]).to_numpy(), values)
+        else:
+            values = pd.merge_asof(left, right, on='pydate', direction='nearest', tolerance=tolerance)[column]
+            values = values.to_numpy(dtype=float)
+
+        result = np.full(len(left), np.nan)
+        result[left['order'].to_numpy()] = values
+        missing = int(np.isnan(result).sum())
+        if missing:
+            self.log.info(f'No CAMS {column} ({match}, tolerance {tolerance}) for {missing} of {len(result)} images, '
+                          f'the CAMS filter is disabled for them.')
+        return result
+
+
+class ZippedProduct:
+    """
+    Context manager giving access to a zipped .SEN3 product (as distributed by ESA) without unpacking it all.
+    Only the members whose file names are in members (and the footprint.* files, if any) are extracted into a
+    temporary folder, which is deleted on exit. With members=None the whole product is extracted.
+
+    with ZippedProduct('S3A_OL_2_WFR____(...).zip', members=needed_files) as sen3_folder:
+        ...
+    """
+
+    def __init__(self, zip_path, members=None, tmp_dir=None, parent_log=None):
+        self.zip_path = zip_path
+        self.members = set(members) if members is not None else None
+        self.tmp_dir = tmp_dir
+        self.log = parent_log if parent_log else logging
+        self.folder = None
+
+    @staticmethod
+    def is_zip(path):
+        return str(path).lower().endswith('.zip') and os.path.isfile(path)
+
+    def _wanted(self, name):
+        base = os.path.basename(name)
+        if not base:  # directory entry
+            return False
+        return self.members is None or base in self.members or base.startswith('footprint.')
+
+    def __enter__(self):
+        self.folder = tempfile.mkdtemp(prefix='sen3r_', dir=self.tmp_dir)
+        try:
+            return self._extract()
+        except BaseException:
+            # __exit__ is not called when __enter__ fails (e.g. corrupt zip, disk full)
+            self.__exit__()
+            raise
+
+    def _extract(self):
+        with zipfile.ZipFile(self.zip_path) as zf:
+            wanted = [m for m in zf.namelist() if self._wanted(m)]
+            self.log.info(f'Extracting {len(wanted)} of {len(zf.namelist())} files from: {self.zip_path}')
+            for member in wanted:
+                zf.extract(member, self.folder)
+        # Products are zipped with their .SEN3 folder inside, otherwise the files are at the root.
+        product_name = os.path.basename(self.zip_path)[:-len('.zip')]
+        roots = {m.split('/')[0] for m in wanted if '/' in m}
+        if len(roots) == 1:
+            return os.path.join(self.folder, roots.pop())
+        sen3_folder = os.path.join(self.folder, product_name if product_name.endswith('.SEN3') else
+                                   product_name + '.SEN3')
+        os.mkdir(sen3_folder)
+        for member in wanted:
+            shutil.move(os.path.join(self.folder, member), sen3_folder)
+        return sen3_folder
+
+    def __exit__(self, *exc):
+        if self.folder:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self.folder = None
+
+
+class MemoryBudget:
+    """
+    Admission control of the work of a run into a memory budget.
+    Tasks are submitted with an estimate of their peak memory and wait until it fits in what is left of the
+    budget, a single task larger than the whole budget still runs, alone. The budget defaults to 80% of
+    Utils.memory_limit() and can be set by --max-memory (in MB), without any of them it is unlimited.
+    """
+
+    MB = 1024 * 1024
+    # Rough peak memory estimates, used by product_footprint and band_footprint
+    process_overhead = 250 * MB  # interpreter + numpy, pandas, netCDF4, GDAL, skimage...
+    df_bytes_per_pixel = 40 * 8 * 3  # ~40 float64 columns, DataFrame + CSV/concat copies
+    olci_pixel_deg = 0.003  # ~300 m OLCI full resolution pixel, in degrees
+    olci_grid_shape = (4091, 4865)  # OLCI full resolution swath, when the grid of a product is not at hand
+
+    def __init__(self, max_memory_mb=None, parent_log=None):
+        self.log = parent_log if parent_log else logging
+        limit = Utils.memory_limit()
+        budgets = [int(limit * 0.8)] if limit else []
+        if max_memory_mb:
+            budgets.append(int(max_memory_mb * self.MB))
+        self.budget = min(budgets) if budgets else None
+        self.used = 0
+        self._cond = threading.Condition()
+
+    @classmethod
+    def roi_pixels(cls, vertices):
+        """
+        Estimate the number of full resolution pixels inside the ROI vertices (lon/lat arrays) and inside their
+        bounding box.
+        """
+        inside = 0
+        for vert in vertices:
+            vert = np.asarray(vert).reshape(-1, 2)
+            x, y = vert[:, 0], vert[:, 1]
+            inside += 0.5 * abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))  # shoelace
+        xmin, xmax, ymin, ymax = Utils.bbox(vertices)
+        box = (xmax - xmin) * (ymax - ymin)
+        return int(inside / cls.olci_pixel_deg ** 2) + 1, int(box / cls.olci_pixel_deg ** 2) + 1
+
+    @classmethod
+    def band_footprint(cls, window_pixels):
+        """
+        Peak memory of reading one band window: its packed values, up to 8 bytes per pixel for the WQSF flags.
+        """
+        return int(window_pixels) * 8
+
+    @classmethod
+    def product_footprint(cls, grid_shape, vertices, band_workers=1):
+        """
+        Peak memory of extracting the ROI of one product whose full resolution grid has grid_shape.
+        """
+        inside, box = cls.roi_pixels(vertices)
+        grid_pixels = int(grid_shape[0]) * int(grid_shape[1])
+        window_pixels = min(box, grid_pixels)
+        return (cls.process_overhead
+                + window_pixels  # uint8 extraction mask
+                + cls.band_footprint(window_pixels) * band_workers
+                + min(inside, grid_pixels) * cls.df_bytes_per_pixel)
+
+    def max_tasks(self, footprint, wanted):
+        """
+        How many tasks of the given footprint fit in the budget at the same time, between 1 and wanted.
+        """
+        if not self.budget or footprint <= 0:
+            return wanted
+        fit = max(1, min(wanted, self.budget // footprint))
+        if fit < wanted:
+            self.log.info(f'Memory budget of {self.budget // self.MB} MB only fits {fit} of {wanted} '
+                          f'tasks of ~{footprint // self.MB} MB, running {fit} at a time.')
+        return fit
+
+    def acquire(self, nbytes):
+        """
+        Block until nbytes fit in the budget and reserve them.
+        """
+        if not self.budget:
+            return
+        with self._cond:
+            while self.used and self.used + nbytes > self.budget:
+                self._cond.wait()
+            if nbytes > self.budget:
+                self.log.info(f'Task of ~{nbytes // self.MB} MB exceeds the memory budget of '
+                              f'{self.budget // self.MB} MB, running it alone.')
+            self.used += nbytes
+
+    def release(self, nbytes):
+        if not self.budget:
+            return
+        with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+    def submit(self, executor, nbytes, fn, *args, **kwargs):
+        """
+        executor.submit(fn, *args, **kwargs) once nbytes fit in the budget, the reservation is released when the
+        task finishes.
+        """
+        self.acquire(nbytes)
+        try:
+            future = executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.release(nbytes)
+            raise
+        future.add_done_callback(lambda _: self.release(nbytes))
+        return future
+
+
 class Footprinter:
 
     @staticmethod
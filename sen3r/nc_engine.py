@@ -1,6 +1,9 @@
 import os
 import sys
 import logging
+import tempfile
+import importlib
+import threading
 #import pyresample  #TODO:https://stackoverflow.com/questions/40009528/find-indices-of-lat-lon-point-on-a-grid-using-python/40044540#40044540
 import netCDF4 as nc
 import numpy as np
@@ -8,28 +11,103 @@ import concurrent.futures
 import pandas as pd
 
 from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
 from skimage.draw import polygon
 from pathlib import Path
 from skimage.transform import resize
+from scipy import ndimage
+from scipy.spatial import cKDTree
 from sen3r import commons
 
+if sys.version_info >= (3, 8):
+    from multiprocessing import shared_memory
+else:
+    shared_memory = None
+
 dd = commons.DefaultDicts()
 utils = commons.Utils()
 
 
+def warm_up_worker(*modules):
+    """
+    Default initializer of the long-lived worker processes. Unpickling it already imports this module, and with it
+    netCDF4, numpy, pandas, scipy and skimage, once per worker instead of in its first task. Any other module the
+    tasks of the pool need can be named in modules (e.g. 'sen3r.tsgen', which also pulls matplotlib and sklearn).
+    """
+    for name in modules:
+        importlib.import_module(name)
+
+
+@contextmanager
+def borrow_executor(executor, pool_class, max_workers=None):
+    """
+    Yield the given executor, which is owned (and shut down) by the caller, or a new pool_class executor
+    that is shut down on exit when none is given.
+    """
+    if executor is not None:
+        yield executor
+    else:
+        with pool_class(max_workers=max_workers or utils.get_available_cores()) as new_executor:
+            yield new_executor
+
+
+def band_packing(var):
+    """
+    The _FillValue, scale_factor and add_offset of a NetCDF variable (None when absent).
+    """
+    return {attr: getattr(var, attr, None) for attr in ('_FillValue', 'scale_factor', 'add_offset')}
+
+
+def unpack_band(raw, packing, dtype=np.float32):
+    """
+    Apply the scale_factor/add_offset of packing to the raw (packed) values of a band, fill values become NaN.
+    Bands that are neither packed nor floating point (i.e. the WQSF flags) are returned untouched.
+    """
+    fill, scale, offset = packing['_FillValue'], packing['scale_factor'], packing['add_offset']
+    if scale is None and offset is None:
+        if not np.issubdtype(raw.dtype, np.floating):
+            return raw
+        values = raw.astype(dtype)
+    else:
+        values = raw * (1.0 if scale is None else float(scale)) + (0.0 if offset is None else float(offset))
+        values = values.astype(dtype)
+    if fill is not None:
+        values[raw == fill] = np.nan
+    return values
+
+
 class NcEngine:
     """
     Provide methods to manipulate NetCDF4 data from Sentinel-3 OLCI products.
     :input_nc_folder: This is the first param.
     :parent_log: This is a second param.
+    :executor: Optional worker pool shared by the whole run, used by the parallel locator.
     """
 
-    def __init__(self, input_nc_folder=None, parent_log=None, product='wfr'):
+    # Sun and observation angles stored in tie_geometries.nc
+    tie_angles = ('OAA', 'OZA', 'SAA', 'SZA')
+
+    # (file, variable) of the red, green and blue bands of the RGB quicklooks
+    rgb_bands = {'wfr': (('Oa08_reflectance.nc', 'Oa08_reflectance'),
+                         ('Oa06_reflectance.nc', 'Oa06_reflectance'),
+                         ('Oa03_reflectance.nc', 'Oa03_reflectance')),
+                 'syn': (('Syn_Oa08_reflectance.nc', 'SDR_Oa08'),
+                         ('Syn_Oa06_reflectance.nc', 'SDR_Oa06'),
+                         ('Syn_Oa03_reflectance.nc', 'SDR_Oa03'))}
+
+    def __init__(self, input_nc_folder=None, parent_log=None, product='wfr', executor=None):
         self.log = parent_log
         self.nc_folder = Path(input_nc_folder)
         self.nc_base_name = os.path.basename(input_nc_folder).split('.')[0]
         self.product = product.lower()
+        self.executor = executor  # Optional long-lived worker pool, owned by the caller
         self.netcdf_valid_band_list = self.get_valid_band_files(rad_only=False)
+        self._full_res_cache = {}
+        self._geo_index = None
+        self._tie_locator = None
+        self._g_lat = None
+        self._g_lon = None
 
         if not self.log:
             TIME_TAG = datetime.now().strftime('%Y%m%dT%H%M%S')
@@ -38,48 +116,126 @@ class NcEngine:
 
         if self.product.lower() == 'wfr':
             self.log.info(f'{os.getpid()} - Initializing geometries for: {self.nc_base_name}')
-            geo_coord = nc.Dataset(self.nc_folder / 'geo_coordinates.nc')
-            self.g_lat = geo_coord['latitude'][:]
-            self.g_lon = geo_coord['longitude'][:]
-
-            # Load and resize tie LON/LAT Bands using the geo_coordinates.nc file dimensions: (4091, 4865)
-            tie_geo = nc.Dataset(self.nc_folder / 'tie_geo_coordinates.nc')
-
-            self.t_lat = tie_geo['latitude'][:]
-            self.t_lat = resize(self.t_lat, (self.g_lat.shape[0], self.g_lat.shape[1]), anti_aliasing=False)
-            self.t_lon = tie_geo['longitude'][:]
-            self.t_lon = resize(self.t_lon, (self.g_lon.shape[0], self.g_lon.shape[1]), anti_aliasing=False)
-
-            # Load and resize Sun Geometry Angle Bands using the geo_coordinates.nc file dimensions: (4091, 4865)
-            t_geometries = nc.Dataset(self.nc_folder / 'tie_geometries.nc')
-
-            self.OAA = t_geometries['OAA'][:]
-            self.OAA = resize(self.OAA, (self.g_lon.shape[0], self.g_lon.shape[1]), anti_aliasing=False)
-            self.OZA = t_geometries['OZA'][:]
-            self.OZA = resize(self.OZA, (self.g_lon.shape[0], self.g_lon.shape[1]), anti_aliasing=False)
-            self.SAA = t_geometries['SAA'][:]
-            self.SAA = resize(self.SAA, (self.g_lon.shape[0], self.g_lon.shape[1]), anti_aliasing=False)
-            self.SZA = t_geometries['SZA'][:]
-            self.SZA = resize(self.SZA, (self.g_lon.shape[0], self.g_lon.shape[1]), anti_aliasing=False)
+            self.geo_file, self.lat_var, self.lon_var = self.nc_folder / 'geo_coordinates.nc', 'latitude', 'longitude'
+            self.tie_geo_file = self.nc_folder / 'tie_geo_coordinates.nc'
+            with nc.Dataset(self.geo_file) as geo_coord:
+                self.grid_shape = geo_coord[self.lat_var].shape
+
+            # Tie point grids are kept at their native (coarse) resolution, full resolution values are
+            # interpolated on demand, either at given pixels (sample_geometries) or for the whole swath.
+            self.tie_geometries = {}
+            with nc.Dataset(self.nc_folder / 'tie_geometries.nc') as t_geometries:
+                for angle in self.tie_angles:
+                    self.tie_geometries[angle] = t_geometries[angle][:]
 
         elif self.product.lower() == 'syn':
-            dsgeo = nc.Dataset(self.nc_folder / 'geolocation.nc')
-            self.g_lat = dsgeo['lat'][:]
-            self.g_lon = dsgeo['lon'][:]
+            self.geo_file, self.lat_var, self.lon_var = self.nc_folder / 'geolocation.nc', 'lat', 'lon'
+            self.tie_geo_file = None
+            with nc.Dataset(self.geo_file) as dsgeo:
+                self.grid_shape = dsgeo[self.lat_var].shape
+            self.tie_geometries = {}
 
         else:
             self.log.info(f'Invalid product: {self.product.upper()}.')
             sys.exit(1)
 
+    def _load_geo_coordinates(self):
+        self.log.info(f'{os.getpid()} - Loading full resolution lat/lon for: {self.nc_base_name}')
+        with nc.Dataset(self.geo_file) as geo_coord:
+            self._g_lat = geo_coord[self.lat_var][:]
+            self._g_lon = geo_coord[self.lon_var][:]
+
+    # The full swath lat/lon is only read by the locators and extraction modes that need it.
+    @property
+    def g_lat(self):
+        if self._g_lat is None:
+            self._load_geo_coordinates()
+        return self._g_lat
+
+    @property
+    def g_lon(self):
+        if self._g_lon is None:
+            self._load_geo_coordinates()
+        return self._g_lon
+
+    def sample_latlon(self, rr, cc, window):
+        """
+        Read lat/lon only inside window (row_min, row_max, col_min, col_max) and return their values at rr, cc.
+        """
+        lat = self.read_window(self.geo_file, self.lat_var, window)
+        lon = self.read_window(self.geo_file, self.lon_var, window)
+        rr, cc = np.asarray(rr) - window[0], np.asarray(cc) - window[2]
+        return lat[rr, cc], lon[rr, cc]
+
+    @staticmethod
+    def read_grid_shape(input_nc_folder, product='wfr'):
+        """
+        Shape of the full resolution grid of a product, only reading the header of its geolocation file.
+        """
+        geo_file, lat_var = ('geolocation.nc', 'lat') if product.lower() == 'syn' else ('geo_coordinates.nc', 'latitude')
+        with nc.Dataset(os.path.join(input_nc_folder, geo_file)) as geo:
+            return geo[lat_var].shape
+
+    def water_pixels(self, mask):
+        """
+        Read only the WQSF window enclosing the RoiMask mask and return, for each of its pixels, whether it passes
+        the WQSF keep/remove rules (see Utils.wqsf_quality). Cheap enough to skip cloudy products before extracting.
+        """
+        wqsf, _ = self.read_raw_window(self.nc_folder / 'wqsf.nc', 'WQSF', mask.window)
+        return utils.wqsf_quality(np.asarray(wqsf).ravel()[mask.index])
+
+    def _full_res_tie(self, tie_grid):
+        # Load and resize a tie point band using the geo_coordinates.nc file dimensions: (4091, 4865)
+        return resize(tie_grid, self.grid_shape, anti_aliasing=False)
+
+    def _lazy_full_res(self, key, loader):
+        if key not in self._full_res_cache:
+            self.log.info(f'{os.getpid()} - Resizing {key} tie points to full resolution for: {self.nc_base_name}')
+            self._full_res_cache[key] = self._full_res_tie(loader())
+        return self._full_res_cache[key]
+
+    def _read_tie_geo(self, var):
+        with nc.Dataset(self.nc_folder / 'tie_geo_coordinates.nc') as tie_geo:
+            return tie_geo[var][:]
+
+    # Full resolution versions of the tie point grids, only computed if someone asks for them.
+    @property
+    def t_lat(self):
+        return self._lazy_full_res('t_lat', lambda: self._read_tie_geo('latitude'))
+
+    @property
+    def t_lon(self):
+        return self._lazy_full_res('t_lon', lambda: self._read_tie_geo('longitude'))
+
+    @property
+    def OAA(self):
+        return self._lazy_full_res('OAA', lambda: self.tie_geometries['OAA'])
+
+    @property
+    def OZA(self):
+        return self._lazy_full_res('OZA', lambda: self.tie_geometries['OZA'])
+
+    @property
+    def SAA(self):
+        return self._lazy_full_res('SAA', lambda: self.tie_geometries['SAA'])
+
+    @property
+    def SZA(self):
+        return self._lazy_full_res('SZA', lambda: self.tie_geometries['SZA'])
+
+    def sample_geometries(self, rr, cc):
+        """
+        Interpolate the tie point angles (OAA, OZA, SAA, SZA) only at the pixels rr, cc of the full resolution grid.
+        Gives the same values as indexing the full resolution arrays (self.OAA[rr, cc], ...) without building them.
+        """
+        return {angle: TieGridSampler(tie_grid, self.grid_shape).sample(rr, cc)
+                for angle, tie_grid in self.tie_geometries.items()}
+
     def __repr__(self):
-        return f'{type(self.t_lat)}, ' \
-               f'{type(self.t_lon)}, ' \
-               f'{type(self.g_lat)}, ' \
+        return f'{type(self.g_lat)}, ' \
                f'{type(self.g_lon)}, ' \
-               f'{type(self.OAA)}, ' \
-               f'{type(self.OZA)}, ' \
-               f'{type(self.SAA)},' \
-               f'{type(self.SZA)},' \
+               f'tie_geometries:{list(self.tie_geometries)}, ' \
+               f'full_res:{list(self._full_res_cache)}, ' \
                f'nc_base_name:{self.nc_base_name}'
 
     def get_valid_band_files(self, rad_only=True):
@@ -104,91 +260,629 @@ class NcEngine:
 
         return nc_bands if rad_only else nc_files
 
-    def latlon_2_xy_poly(self, poly_path, go_parallel=False):
+    @property
+    def geo_index(self):
+        """
+        Spatial index over geo_coordinates.nc, built once per product on first use.
+        """
+        if self._geo_index is None:
+            self.log.info(f'{os.getpid()} - Building lat/lon index for: {self.nc_base_name}')
+            self._geo_index = GeoIndex(self.g_lat, self.g_lon)
+        return self._geo_index
+
+    @property
+    def tie_locator(self):
+        """
+        Coarse-to-fine vertex locator based on tie_geo_coordinates.nc, built once per product on first use.
+        """
+        if self._tie_locator is None:
+            self._tie_locator = TieLocator(self.geo_file, self.tie_geo_file, self.lat_var, self.lon_var)
+        return self._tie_locator
+
+    def latlon_2_xy_poly(self, poly_path, go_parallel=False, locator='kdtree'):
         """
         Given an input polygon and image, return a dataframe containing
         the data of the image that falls inside the polygon.
+        locator: 'kdtree' (default), 'tie', 'parallel' or 'brute'. go_parallel=True is the same as locator='parallel'.
         """
         self.log.info(f'Converting the polygon coordinates into a matrix x,y poly...')
+        if go_parallel:
+            locator = 'parallel'
         # I) Convert the lon/lat polygon into a x/y poly:
-        xy_vert, ll_vert = self._lat_lon_2_xy(poly_path=poly_path, parallel=go_parallel)
+        xy_vert, ll_vert = self._lat_lon_2_xy(poly_path=poly_path, locator=locator)
 
         return xy_vert, ll_vert
 
-    def _lat_lon_2_xy(self, poly_path, geojson=True, parallel=True):
+    def _lat_lon_2_xy(self, poly_path, geojson=True, locator='kdtree'):
         """
         Takes in a polygon file and return a dataframe containing
         the data in each band that falls inside the polygon.
         """
         # self._test_initialized()
 
-        if parallel:
-            gpc = ParallelCoord()
+        if locator == 'tie' and self.tie_geo_file is None:
+            self.log.info(f'No tie point grid for {self.product.upper()} products, using the kdtree locator.')
+            locator = 'kdtree'
+
+        if locator == 'kdtree':
+            xy_vertices = self.geo_index.query_polys(poly_path)
+        elif locator == 'tie':
+            xy_vertices = self.tie_locator.query_polys(poly_path, fallback=lambda lat, lon: self.geo_index.query(lat, lon))
+        elif locator == 'parallel':
+            gpc = ParallelCoord(executor=self.executor)
 
             xy_vertices = [gpc.parallel_get_xy_poly(self.g_lat, self.g_lon, vert) for vert in poly_path]
-        else:
+        elif locator == 'brute':
             xy_vertices = [utils.get_x_y_poly(self.g_lat, self.g_lon, vert) for vert in poly_path]
+        else:
+            self.log.info(f'Invalid vertex locator: {locator}.')
+            sys.exit(1)
 
         return xy_vertices, poly_path
 
     def get_raster_mask(self, xy_vertices):
         """
-        Creates a boolean mask of 0 and 1 with the polygons using the nc resolution.
+        Creates the RoiMask of the polygons using the nc resolution.
+        Returns the mask and the deduplicated cc, rr pixels inside the polygons, in row-major order.
         """
-        # self._test_initialized()
-        # Generate extraction mask
+        mask = RoiMask.from_polygons(xy_vertices, self.get_roi_window(xy_vertices))
+        return mask, mask.cc, mask.rr
+
+    def get_pixels_mask(self, rr, cc, window=None):
+        """
+        Rebuild the RoiMask returned by get_raster_mask from the rr, cc pixels of the polygons.
+        """
+        return RoiMask.from_pixels(rr, cc, window)
+
+    def get_roi_window(self, xy_vertices):
+        """
+        Get the hyperslab of the image that encloses all the polygons in xy_vertices.
+        Returns (row_min, row_max, col_min, col_max) with exclusive upper bounds, so the window
+        can be used directly to slice a NetCDF variable: var[row_min:row_max, col_min:col_max].
+        """
+        xmin, xmax, ymin, ymax = utils.bbox(xy_vertices)
+        n_rows, n_cols = self.grid_shape
 
-        img = np.zeros(self.g_lon.shape)
-        cc = np.ndarray(shape=(0,), dtype='int64')
-        rr = np.ndarray(shape=(0,), dtype='int64')
+        row_min = int(max(ymin, 0))
+        row_max = int(min(ymax + 1, n_rows))
+        col_min = int(max(xmin, 0))
+        col_max = int(min(xmax + 1, n_cols))
 
-        for vert in xy_vertices:
-            t_rr, t_cc = polygon(vert[:, 0], vert[:, 1], self.g_lon.shape)
-            img[t_rr, t_cc] = 1
-            cc = np.append(cc, t_cc)
-            rr = np.append(rr, t_rr)
+        return row_min, row_max, col_min, col_max
+
+    @staticmethod
+    def read_window(nc_file, nc_band, window=None):
+        """
+        Read only the hyperslab given by window (row_min, row_max, col_min, col_max) of a NetCDF variable.
+        If window is None the whole variable is loaded.
+        """
+        with nc.Dataset(nc_file) as ds:
+            if window is None:
+                return ds[nc_band][:]
+            row_min, row_max, col_min, col_max = window
+            return ds[nc_band][row_min:row_max, col_min:col_max]
 
-        return img, cc, rr
+    @staticmethod
+    def read_raw_window(nc_file, nc_band, window=None):
+        """
+        Same as read_window, but the values are returned packed, as stored in the file (no mask nor scaling),
+        together with their band_packing.
+        """
+        with nc.Dataset(nc_file) as ds:
+            return NcEngine._raw_window(ds[nc_band], window)
 
-    def get_rgb_from_poly(self, xy_vertices):
+    @staticmethod
+    def _raw_window(var, window=None):
+        var.set_auto_maskandscale(False)
+        if window is None:
+            return var[:], band_packing(var)
+        row_min, row_max, col_min, col_max = window
+        return var[row_min:row_max, col_min:col_max], band_packing(var)
 
+    def get_rgb_from_poly(self, xy_vertices, band_windows=None, window=None, max_size=None):
+        """
+        RGB quicklook (Oa08, Oa06, Oa03) of the bounding box of the polygons.
+        The bands are sliced from band_windows {nc_band: array} when they hold them (i.e. the windows kept by
+        ParallelBandExtract during the extraction, read over window), otherwise only the bbox is read from the files.
+        If max_size is given, the quicklook is decimated so its largest side has at most max_size pixels.
+        """
         # II) Get the bounding box:
         xmin, xmax, ymin, ymax = utils.bbox(xy_vertices)
+        # Same subset as band[ymin:ymax, xmin:xmax], but read straight from the files.
+        bbox_window = (ymin, ymax, xmin, xmax)
 
-        # III) Get only the RGB bands:
-        if self.product.lower() == 'wfr':
-            ds = nc.Dataset(self.nc_folder / 'Oa08_reflectance.nc')
-            red = ds['Oa08_reflectance'][:]
-            ds = nc.Dataset(self.nc_folder / 'Oa06_reflectance.nc')
-            green = ds['Oa06_reflectance'][:]
-            ds = nc.Dataset(self.nc_folder / 'Oa03_reflectance.nc')
-            blue = ds['Oa03_reflectance'][:]
-
-        elif self.product.lower() == 'syn':
-            ds = nc.Dataset(self.nc_folder / 'Syn_Oa08_reflectance.nc')
-            red = ds['SDR_Oa08'][:]
-            ds = nc.Dataset(self.nc_folder / 'Syn_Oa06_reflectance.nc')
-            green = ds['SDR_Oa06'][:]
-            ds = nc.Dataset(self.nc_folder / 'Syn_Oa03_reflectance.nc')
-            blue = ds['SDR_Oa03'][:]
-        else:
+        # III) Get only the RGB bands inside the bbox:
+        if self.product.lower() not in self.rgb_bands:
             self.log.info(f'Invalid product: {self.product.upper()}.')
             sys.exit(1)
+        row_off, col_off = (window[0], window[2]) if window else (0, 0)
+        red, green, blue = [self._rgb_band(nc_file, nc_band, bbox_window, (band_windows or {}).get(nc_band),
+                                           row_off, col_off)
+                            for nc_file, nc_band in self.rgb_bands[self.product.lower()]]
 
-        # IV) Subset the bands using the bbox:
-        red = red[ymin:ymax, xmin:xmax]
-        green = green[ymin:ymax, xmin:xmax]
-        blue = blue[ymin:ymax, xmin:xmax]
+        if max_size:
+            step = max(1, -(-max(red.shape) // int(max_size)))  # ceil
+            red, green, blue = red[::step, ::step], green[::step, ::step], blue[::step, ::step]
 
-        # V) Stack the bands vertically:
+        # IV) Stack the bands vertically:
         # https://stackoverflow.com/questions/10443295/combine-3-separate-numpy-arrays-to-an-rgb-image-in-python
         rgb_uint8 = (np.dstack((red, green, blue)) * 255.999).astype(np.uint8)
 
         return red, green, blue, rgb_uint8
 
+    def _rgb_band(self, nc_file, nc_band, bbox_window, in_memory=None, row_off=0, col_off=0):
+        ymin, ymax, xmin, xmax = bbox_window
+        if in_memory is not None and ymin >= row_off and xmin >= col_off and \
+                ymax - row_off <= in_memory.shape[0] and xmax - col_off <= in_memory.shape[1]:
+            return in_memory[ymin - row_off:ymax - row_off, xmin - col_off:xmax - col_off]
+        return self.read_window(self.nc_folder / nc_file, nc_band, bbox_window)
+
+
+class PixelBatch:
+    """
+    Struct of arrays holding the pixels extracted from a product: their int32 row/col indexes, one array per band
+    (float32 once unpacked, the WQSF flags stay uint64) and a boolean validity mask. Filtering only clears bits of
+    the mask (see keep and where), the arrays are shared and only gathered by to_pandas/to_arrow, once.
+    index is the position of each pixel in the rr, cc given to ParallelBandExtract.
+    """
+
+    __slots__ = ('rr', 'cc', 'columns', 'index', 'valid')
+
+    flags_column = 'WQSF'
+
+    def __init__(self, rr, cc, columns, index=None, valid=None):
+        self.rr = np.asarray(rr).astype(np.int32, copy=False)
+        self.cc = np.asarray(cc).astype(np.int32, copy=False)
+        self.columns = columns  # {name: 1-D array}, in the order of the output columns
+        self.index = np.arange(len(self.rr)) if index is None else np.asarray(index)
+        self.valid = np.ones(len(self.rr), dtype=bool) if valid is None else np.asarray(valid, dtype=bool)
+
+    @property
+    def flags(self):
+        return self.columns.get(self.flags_column)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.valid))
+
+    def keep(self, mask):
+        """
+        Invalidate, in place, the pixels where mask is False.
+        """
+        self.valid &= mask
+        return self
+
+    def where(self, mask):
+        """
+        New batch sharing the arrays of this one, whose valid pixels are those also True in mask.
+        """
+        return PixelBatch(self.rr, self.cc, self.columns, self.index, self.valid & mask)
+
+    def _selection(self):
+        # A full slice keeps views of the arrays when every pixel is valid
+        return slice(None) if self.valid.all() else self.valid
+
+    def _valid_columns(self, names=None):
+        sel = self._selection()
+        names = names or {}
+        data = {'x': self.rr[sel], 'y': self.cc[sel]}
+        data.update({names.get(name, name): values[sel] for name, values in self.columns.items()})
+        return data, self.index[sel]
+
+    def to_pandas(self, names=None):
+        """
+        DataFrame of the valid pixels, with the x, y columns followed by one column per array, renamed by the
+        optional dict names (e.g. DefaultDicts.wfr_vld_names). Indexed by the positions of the pixels.
+        """
+        data, index = self._valid_columns(names)
+        return pd.DataFrame(data, index=index, copy=False)
+
+    def to_arrow(self, names=None):
+        """
+        Same as to_pandas, as a pyarrow Table (without copying the numeric arrays when every pixel is valid).
+        """
+        if commons.pa is None:
+            raise ImportError('pyarrow is required by PixelBatch.to_arrow')
+        data, _ = self._valid_columns(names)
+        return commons.pa.table({name: commons.pa.array(np.ma.filled(values, np.nan) if np.ma.isMaskedArray(values)
+                                                        else values)
+                                 for name, values in data.items()})
+
+
+class RoiMask:
+    """
+    Pixels of the ROI polygons of a product, bounded to the window (row_min, row_max, col_min, col_max) that
+    encloses them: a uint8 mask of the window and the deduplicated int32 linear (row-major) indexes of its pixels.
+    Pixels shared by overlapping polygons are only kept once. See union for the labeled mask of several ROIs.
+    """
+
+    def __init__(self, window, mask):
+        self.window = tuple(int(w) for w in window)
+        self.mask = mask
+        self.index = np.flatnonzero(mask).astype(np.int32)
+
+    @classmethod
+    def from_polygons(cls, xy_vertices, window):
+        """
+        Rasterize every polygon of xy_vertices into a single mask of the window.
+        """
+        row_min, row_max, col_min, col_max = window
+        shape = (row_max - row_min, col_max - col_min)
+        mask = np.zeros(shape, dtype=np.uint8)
+        for vert in xy_vertices:
+            t_rr, t_cc = polygon(vert[:, 0] - row_min, vert[:, 1] - col_min, shape)
+            mask[t_rr, t_cc] = 1
+        return cls(window, mask)
+
+    @classmethod
+    def from_pixels(cls, rr, cc, window=None):
+        """
+        Mask of the rr, cc pixels (full swath coordinates), the window defaults to their extent.
+        """
+        rr, cc = np.asarray(rr), np.asarray(cc)
+        if window is None:
+            window = (rr.min(initial=0), rr.max(initial=-1) + 1, cc.min(initial=0), cc.max(initial=-1) + 1)
+        row_min, row_max, col_min, col_max = window
+        mask = np.zeros((row_max - row_min, col_max - col_min), dtype=np.uint8)
+        mask[rr - row_min, cc - col_min] = 1
+        return cls(window, mask)
+
+    @classmethod
+    def union(cls, masks):
+        """
+        Merge the masks of several ROIs into a single labeled mask over the window enclosing all of them, where the
+        pixels of the k-th ROI are labeled k + 1 (on overlaps the last ROI wins).
+        Returns the labeled RoiMask and, for each ROI, the positions of its pixels in the pixels of the union.
+        """
+        row_min = min(m.window[0] for m in masks)
+        row_max = max(m.window[1] for m in masks)
+        col_min = min(m.window[2] for m in masks)
+        col_max = max(m.window[3] for m in masks)
+        labels = np.zeros((row_max - row_min, col_max - col_min), dtype=np.int32)
+        for label, m in enumerate(masks, start=1):
+            view = labels[m.window[0] - row_min:m.window[1] - row_min, m.window[2] - col_min:m.window[3] - col_min]
+            view[m.mask != 0] = label
+        union = cls((row_min, row_max, col_min, col_max), labels)
+
+        members = []
+        for m in masks:
+            lin = (m.rr - row_min) * labels.shape[1] + (m.cc - col_min)
+            members.append(np.searchsorted(union.index, lin))
+        return union, members
+
+    @property
+    def rr(self):
+        return (self.index // self.mask.shape[1] + self.window[0]).astype(np.int64)
+
+    @property
+    def cc(self):
+        return (self.index % self.mask.shape[1] + self.window[2]).astype(np.int64)
+
+    def __len__(self):
+        return len(self.index)
+
+    def to_full(self, grid_shape):
+        """
+        The full swath 0/1 mask, as it used to be returned by get_raster_mask.
+        """
+        img = np.zeros(grid_shape)
+        row_min, row_max, col_min, col_max = self.window
+        img[row_min:row_max, col_min:col_max] = self.mask
+        return img
+
+
+class TieGridSampler:
+    """
+    Bilinear interpolation of a coarse tie point grid at given pixels of the full resolution grid.
+    Follows the same pixel mapping as skimage.transform.resize(tie_grid, full_shape, anti_aliasing=False),
+    so sampling every pixel of the swath would return the resized array.
+    """
+
+    def __init__(self, tie_grid, full_shape):
+        # resize works on the raw data of masked arrays, so do we.
+        self.tie_grid = np.asarray(tie_grid, dtype=float)
+        self.full_shape = full_shape
+
+    def to_tie_coords(self, rr, cc):
+        """
+        Convert full resolution row/col indexes into (fractional) row/col positions in the tie grid.
+        """
+        row_scale = self.tie_grid.shape[0] / self.full_shape[0]
+        col_scale = self.tie_grid.shape[1] / self.full_shape[1]
+        t_rr = (np.asarray(rr, dtype=float) + 0.5) * row_scale - 0.5
+        t_cc = (np.asarray(cc, dtype=float) + 0.5) * col_scale - 0.5
+        return t_rr, t_cc
+
+    def sample(self, rr, cc):
+        t_rr, t_cc = self.to_tie_coords(rr, cc)
+        # 'mirror' is the scipy equivalent of the default 'reflect' mode used by skimage.
+        return ndimage.map_coordinates(self.tie_grid, [t_rr, t_cc], order=1, mode='mirror')
+
+
+class GeoIndex:
+    """
+    KD-tree over the lat/lon of every pixel of the image, used to find the nearest pixel of polygon vertices.
+    Distances are measured in the same (lat, lon) space as Utils.get_x_y_poly, so the returned x,y are the same.
+    """
+
+    # Number of neighbours fetched per vertex to solve equidistant pixels like get_x_y_poly does (first in the grid).
+    ties = 4
+
+    def __init__(self, lat_arr, lon_arr):
+        self.shape = lat_arr.shape
+        lat = np.ma.filled(np.ma.asarray(lat_arr, dtype=float), np.nan).ravel()
+        lon = np.ma.filled(np.ma.asarray(lon_arr, dtype=float), np.nan).ravel()
+        # Masked or invalid pixels are never the nearest one, keep them out of the tree
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        self.flat_index = np.flatnonzero(valid)
+        self.tree = cKDTree(np.column_stack((lat[valid], lon[valid])), balanced_tree=False, compact_nodes=False)
+
+    def query(self, lat, lon):
+        """
+        Return an array of (x, y) pixel indexes, one for each lat/lon point.
+        """
+        k = min(self.ties, self.tree.n)
+        dist, idx = self.tree.query(np.column_stack((lat, lon)), k=k)
+        dist, idx = dist.reshape(len(lat), k), idx.reshape(len(lat), k)
+        flat = self.flat_index[idx]
+        # Among equidistant neighbours keep the first one in row-major order.
+        flat = np.where(dist == dist[:, :1], flat, np.iinfo(flat.dtype).max).min(axis=1)
+        return np.column_stack(np.unravel_index(flat, self.shape))
+
+    def query_polys(self, poly_path):
+        """
+        Convert every GeoJSON (lon, lat) polygon of poly_path to x,y in a single batched query.
+        """
+        polylines = [np.asarray(vert).reshape(-1, 2) for vert in poly_path]
+        if not polylines:
+            return []
+        lonlat = np.concatenate(polylines)
+        xy = self.query(lat=lonlat[:, 1], lon=lonlat[:, 0])
+        return np.split(xy, np.cumsum([len(p) for p in polylines])[:-1])
+
+
+class TieLocator:
+    """
+    Two stage vertex locator: find the nearest point of the coarse tie_geo_coordinates.nc grid first, then refine
+    it to the nearest pixel inside a small window of geo_coordinates.nc around it.
+    Only the hyperslab enclosing the polygons is read, the full geolocation arrays are never loaded.
+    """
+
+    # Full resolution pixels searched around the tie point estimate, on top of the tie point spacing.
+    margin = 4
+    # How many times the search window may double when the nearest pixel falls on its border.
+    max_grow = 4
+
+    def __init__(self, geo_file, tie_file, lat_var='latitude', lon_var='longitude'):
+        self.geo_file = geo_file
+        self.lat_var = lat_var
+        self.lon_var = lon_var
+
+        with nc.Dataset(geo_file) as geo_coord:
+            self.shape = geo_coord[lat_var].shape
+
+        with nc.Dataset(tie_file) as tie_geo:
+            t_lat = tie_geo[lat_var][:]
+            t_lon = tie_geo[lon_var][:]
+            # Along and across track spacing between two tie points, in full resolution pixels.
+            self.al_factor = getattr(tie_geo, 'al_subsampling_factor', self._spacing(self.shape[0], t_lat.shape[0]))
+            self.ac_factor = getattr(tie_geo, 'ac_subsampling_factor', self._spacing(self.shape[1], t_lat.shape[1]))
+
+        self.tie_index = GeoIndex(t_lat, t_lon)
+        self.buffer = None
+        self.buffer_window = None
+
+    @staticmethod
+    def _spacing(full_size, tie_size):
+        return (full_size - 1) / (tie_size - 1) if tie_size > 1 else full_size
+
+    def _read(self, window):
+        # Serve from the in-memory hyperslab whenever possible, otherwise go back to the file.
+        b_rmin, b_rmax, b_cmin, b_cmax = self.buffer_window
+        row_min, row_max, col_min, col_max = window
+        if b_rmin <= row_min and row_max <= b_rmax and b_cmin <= col_min and col_max <= b_cmax:
+            rows = slice(row_min - b_rmin, row_max - b_rmin)
+            cols = slice(col_min - b_cmin, col_max - b_cmin)
+            return self.buffer[0][rows, cols], self.buffer[1][rows, cols]
+        return self._read_file(window)
+
+    def _read_file(self, window):
+        lat = NcEngine.read_window(self.geo_file, self.lat_var, window)
+        lon = NcEngine.read_window(self.geo_file, self.lon_var, window)
+        return np.ma.filled(lat.astype(float), np.nan), np.ma.filled(lon.astype(float), np.nan)
+
+    def _window(self, row, col, half_rows, half_cols):
+        return (max(row - half_rows, 0), min(row + half_rows + 1, self.shape[0]),
+                max(col - half_cols, 0), min(col + half_cols + 1, self.shape[1]))
+
+    def _refine(self, lat, lon, row, col, half_rows, half_cols):
+        for _ in range(self.max_grow + 1):
+            window = self._window(row, col, half_rows, half_cols)
+            g_lat, g_lon = self._read(window)
+            dist = np.sqrt((g_lat - lat) ** 2 + (g_lon - lon) ** 2)
+            if not np.isnan(dist).all():
+                i, j = np.unravel_index(np.nanargmin(dist), dist.shape)
+                row, col = window[0] + i, window[2] + j
+                on_border = (i == 0 and window[0] > 0) or (i == dist.shape[0] - 1 and window[1] < self.shape[0]) or \
+                            (j == 0 and window[2] > 0) or (j == dist.shape[1] - 1 and window[3] < self.shape[1])
+                if not on_border:
+                    return [row, col]
+            # The nearest pixel may lie outside the window, search again around the best guess with a larger one.
+            half_rows, half_cols = half_rows * 2, half_cols * 2
+        return None
+
+    def query(self, lat, lon, fallback=None):
+        """
+        Return an array of (x, y) pixel indexes, one for each lat/lon point.
+        Points that can't be resolved locally are passed to fallback(lat, lon), if given.
+        """
+        lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+        coarse = self.tie_index.query(lat, lon)
+        rows = np.clip(np.rint(coarse[:, 0] * self.al_factor).astype(int), 0, self.shape[0] - 1)
+        cols = np.clip(np.rint(coarse[:, 1] * self.ac_factor).astype(int), 0, self.shape[1] - 1)
+        half_rows = int(np.ceil(self.al_factor)) + self.margin
+        half_cols = int(np.ceil(self.ac_factor)) + self.margin
+
+        # One single read of geo_coordinates.nc covering the search windows of every point.
+        self.buffer_window = (max(rows.min() - half_rows, 0), min(rows.max() + half_rows + 1, self.shape[0]),
+                              max(cols.min() - half_cols, 0), min(cols.max() + half_cols + 1, self.shape[1]))
+        self.buffer = self._read_file(self.buffer_window)
+
+        xy = []
+        for n in range(len(lat)):
+            target = self._refine(lat[n], lon[n], rows[n], cols[n], half_rows, half_cols)
+            if target is None:
+                if fallback is None:
+                    target = [rows[n], cols[n]]
+                else:
+                    target = list(fallback(lat[n:n + 1], lon[n:n + 1])[0])
+            xy.append(target)
+
+        self.buffer = None
+        return np.array(xy, dtype=int).reshape(-1, 2)
+
+    def query_polys(self, poly_path, fallback=None):
+        """
+        Convert every GeoJSON (lon, lat) polygon of poly_path to x,y.
+        """
+        polylines = [np.asarray(vert).reshape(-1, 2) for vert in poly_path]
+        if not polylines:
+            return []
+        lonlat = np.concatenate(polylines)
+        xy = self.query(lat=lonlat[:, 1], lon=lonlat[:, 0], fallback=fallback)
+        return np.split(xy, np.cumsum([len(p) for p in polylines])[:-1])
+
+
+class SharedArray:
+    """
+    Numpy array stored in a multiprocessing.shared_memory block (a memory-mapped temporary file on Python < 3.8).
+    Worker processes receive only its small picklable handle and map the same memory, instead of unpickling a copy
+    of the array for every task. The process that creates the array must call release() once it is done.
+    """
+
+    def __init__(self, shape, dtype, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+        size = int(np.prod(self.shape))
+        # Zero sized blocks are not allowed, keep at least one element.
+        nbytes = max(size, 1) * self.dtype.itemsize
+
+        if shared_memory:
+            # Workers share the resource tracker of the process that created the block, which unlinks it.
+            self._shm = shared_memory.SharedMemory(name=name, create=self.owner, size=nbytes if self.owner else 0)
+            self.name = self._shm.name
+            buffer = self._shm.buf
+        else:
+            if self.owner:
+                fd, name = tempfile.mkstemp(prefix='sen3r_', suffix='.shm')
+                os.close(fd)
+            self._shm = None
+            self.name = name
+            buffer = np.memmap(name, dtype=np.uint8, mode='r+' if not self.owner else 'w+', shape=(nbytes,))
+
+        self.array = np.ndarray((size,), dtype=self.dtype, buffer=buffer).reshape(self.shape)
+
+    @classmethod
+    def from_array(cls, arr):
+        arr = np.asarray(arr)
+        shared = cls(arr.shape, arr.dtype)
+        shared.array[...] = arr
+        return shared
+
+    @property
+    def handle(self):
+        return self.name, self.shape, self.dtype.str
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Map the array described by handle, usually inside a worker process. Call close() when done.
+        """
+        name, shape, dtype = handle
+        return cls(shape, dtype, name=name)
+
+    def close(self):
+        self.array = None
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError:
+                # Some view of the block is still alive, it will be unmapped with the process.
+                pass
+
+    def release(self):
+        """
+        Close and destroy the block. Only the process that created it should call this.
+        """
+        self.close()
+        if self.owner:
+            if self._shm is not None:
+                self._shm.unlink()
+            elif os.path.exists(self.name):
+                os.remove(self.name)
+
+
+class DatasetPool:
+    """
+    Bounded pool of open netCDF4.Dataset handles, shared by the threads that read the bands of a product.
+    A handle is opened once and reused by every read of the same file. When max_open handles are open, the least
+    recently used one is closed to make room. close() closes them all.
+    The netCDF-C library is not thread-safe, not even across different files, so every call into it is serialized
+    under one lock; the threads only overlap the unpacking and the pixel gathering.
+    """
+    _nc_lock = threading.Lock()
+
+    def __init__(self, max_open=32):
+        self.max_open = max(int(max_open), 1)
+        self._handles = OrderedDict()
+
+    def _dataset(self, nc_file):
+        # Must be called holding _nc_lock
+        nc_file = str(nc_file)
+        if nc_file not in self._handles:
+            if len(self._handles) >= self.max_open:
+                _, ds = self._handles.popitem(last=False)
+                ds.close()
+            self._handles[nc_file] = nc.Dataset(nc_file)
+        self._handles.move_to_end(nc_file)
+        return self._handles[nc_file]
+
+    def read_window(self, nc_file, nc_band, window=None):
+        """
+        Same as NcEngine.read_window, but using the pooled handle of nc_file.
+        """
+        with self._nc_lock:
+            ds = self._dataset(nc_file)
+            if window is None:
+                return ds[nc_band][:]
+            row_min, row_max, col_min, col_max = window
+            return ds[nc_band][row_min:row_max, col_min:col_max]
+
+    def read_raw_window(self, nc_file, nc_band, window=None):
+        """
+        Same as NcEngine.read_raw_window, but using the pooled handle of nc_file.
+        """
+        with self._nc_lock:
+            return NcEngine._raw_window(self._dataset(nc_file)[nc_band], window)
+
+    def close(self):
+        with self._nc_lock:
+            for ds in self._handles.values():
+                ds.close()
+            self._handles.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 
 class ParallelCoord:
 
+    def __init__(self, executor=None):
+        self.executor = executor
+
     @staticmethod
     def vect_dist_subtraction(coord_pair, grid):
         subtraction = coord_pair - grid
@@ -197,6 +891,19 @@ class ParallelCoord:
         target_x_y = [result[0][0], result[1][0]]
         return target_x_y
 
+    @staticmethod
+    def shared_vect_dist_subtraction(n, coord_pair, grid_handle, out_handle):
+        """
+        Same as vect_dist_subtraction, but the grid is read from and the result is written to shared memory.
+        """
+        grid = SharedArray.attach(grid_handle)
+        out = SharedArray.attach(out_handle)
+        try:
+            out.array[n] = ParallelCoord.vect_dist_subtraction(coord_pair, grid.array)
+        finally:
+            grid.close()
+            out.close()
+
     def parallel_get_xy_poly(self, lat_arr, lon_arr, polyline):
         # Stack LAT and LON in the Z axis
         grid = np.concatenate([lat_arr[..., None], lon_arr[..., None]], axis=2)
@@ -212,77 +919,273 @@ class ParallelCoord:
 
         # for future reference
         # https://stackoverflow.com/questions/6832554/multiprocessing-how-do-i-share-a-dict-among-multiple-processes
-        cores = utils.get_available_cores()
-        with concurrent.futures.ProcessPoolExecutor(max_workers=cores) as executor:
-            try:
-                result = list(executor.map(self.vect_dist_subtraction, coord_vect_pairs, [grid]*len(coord_vect_pairs)))
+        # The grid goes to the workers through shared memory, each task only carries the handles.
+        shared_grid = SharedArray.from_array(grid)
+        del grid
+        shared_out = SharedArray((len(coord_vect_pairs), 2), np.int64)
+        n_pairs = len(coord_vect_pairs)
+        try:
+            with borrow_executor(self.executor, concurrent.futures.ProcessPoolExecutor) as executor:
+                try:
+                    list(executor.map(self.shared_vect_dist_subtraction, range(n_pairs), coord_vect_pairs,
+                                      [shared_grid.handle] * n_pairs, [shared_out.handle] * n_pairs))
+
+                except concurrent.futures.process.BrokenProcessPool as ex:
+                    print(f"{ex} This might be caused by limited system resources. "
+                          f"Locating the remaining vertices in the current process.")
+                    for n, coord_pair in enumerate(coord_vect_pairs):
+                        shared_out.array[n] = self.vect_dist_subtraction(coord_pair, shared_grid.array)
 
-            except concurrent.futures.process.BrokenProcessPool as ex:
-                print(f"{ex} This might be caused by limited system resources. "
-                      f"Try increasing system memory or disable concurrent processing. ")
+            result = shared_out.array.copy()
+        finally:
+            shared_grid.release()
+            shared_out.release()
 
-        return np.array(result)
+        return result
 
 
 class ParallelBandExtract:
+    """
+    Extract the pixels of a product from every NetCDF band.
+    backend='process' (default) reads the bands from a process pool, passing the pixels through shared memory.
+    backend='thread' reads them from a thread pool inside the current process, sharing a bounded pool of open
+    Dataset handles, with no process spawn nor pickling. The netCDF calls are serialized (see DatasetPool), so the
+    bands are read and decompressed one at a time, only their unpacking and gathering overlap.
+    A long-lived executor of the matching kind can be given, otherwise a new one is created for every product.
+    With a commons.MemoryBudget, band reads are only admitted while their window fits in the budget.
+    The windows read for the keep_bands (i.e. the RGB bands) are kept in band_windows by the thread backend.
+    """
 
-    def __init__(self, parent_log=None):
-        if parent_log:
-            self.log = parent_log
+    def __init__(self, parent_log=None, backend='process', max_open_files=32, executor=None, budget=None,
+                 keep_bands=()):
+        self.log = parent_log if parent_log else logging
+        self.backend = backend
+        self.max_open_files = max_open_files
+        self.executor = executor
+        self.budget = budget
+        self.keep_bands = set(keep_bands)
+        self.band_windows = {}
+        self.absvld_index = None
+        # Set when the process pool broke, the executor is then dropped and the bands are read with threads.
+        self.pool_broken = False
+
+    def _submit(self, executor, window_pixels, fn, *args):
+        if self.budget:
+            return self.budget.submit(executor, commons.MemoryBudget.band_footprint(window_pixels), fn, *args)
+        return executor.submit(fn, *args)
+
+    @staticmethod
+    def _window_pixels(rr, cc, window=None):
+        if window:
+            return (window[1] - window[0]) * (window[3] - window[2])
+        return (int(np.max(rr, initial=0)) + 1) * (int(np.max(cc, initial=0)) + 1)
 
-    def _get_band_in_nc(self, file_n_band, rr, cc):
+    def _get_band_in_nc(self, file_n_band, rr, cc, window=None):
 
         print(f'{os.getpid()} | Extracting band: {file_n_band[1]} from file: {file_n_band[0]}.\n')
         # logging.info(f'{os.getpid()} | Extracting band: {file_n_band[1]} from file: {file_n_band[0]}.\n')
         # self.log.info(f'{os.getpid()} | Extracting band: {file_n_band[1]} from file: {file_n_band[0]}.\n')
         result = {}
-        # load NetCDF folder + nc_file_name
-        ds = nc.Dataset(file_n_band[0])
-        # load the nc_band_name as a matrix and unmask its values
-        band = ds[file_n_band[1]][:].data
         # extract the values of the matrix and return as a dict entry
-        result[file_n_band[1]] = [band[x, y] for x, y in zip(rr, cc)]
+        result[file_n_band[1]] = unpack_band(*self._gather_band(file_n_band, rr, cc, window))
         return result
 
-    def nc_2_df(self, rr, cc, oaa, oza, saa, sza, lon, lat, nc_folder, wfr_files_p, parent_log=None):
+    @staticmethod
+    def _gather_band(file_n_band, rr, cc, window=None, reader=NcEngine.read_raw_window):
+        """
+        Packed values of the band at the rr, cc pixels and the band_packing to unpack them.
+        """
+        # load only the window of nc_band_name from NetCDF folder + nc_file_name, as stored in the file
+        band, packing = reader(file_n_band[0], file_n_band[1], window)
+        # rr, cc are given in full swath coordinates, shift them to the window origin
+        row_off, col_off = (window[0], window[2]) if window else (0, 0)
+        return band[np.asarray(rr) - row_off, np.asarray(cc) - col_off], packing
+
+    @staticmethod
+    def _masked_window(raw, packing):
+        """
+        The masked and scaled array netCDF4 would have returned for the raw window of a band.
+        """
+        fill = packing['_FillValue']
+        values = unpack_band(raw, packing, dtype=np.float64)
+        if fill is None:
+            return np.ma.masked_array(values)
+        mask = raw == fill
+        values[mask] = raw[mask]
+        return np.ma.masked_array(values, mask=mask)
+
+    @staticmethod
+    def _get_band_in_shm(file_n_band, pixels_handle, out_handle, window=None):
+        """
+        Same as _get_band_in_nc, but rr, cc are read from shared memory and the band values are written back to it.
+        The shared output is a raw 8 bytes per pixel buffer, the dtype of the band is returned to interpret it.
+        """
+        print(f'{os.getpid()} | Extracting band: {file_n_band[1]} from file: {file_n_band[0]}.\n')
+        pixels = SharedArray.attach(pixels_handle)
+        out = SharedArray.attach(out_handle)
+        try:
+            values, packing = ParallelBandExtract._gather_band(file_n_band, pixels.array[0], pixels.array[1], window)
+            out.array.view(values.dtype)[:len(values)] = values
+        finally:
+            pixels.close()
+            out.close()
+        return file_n_band[1], values.dtype.str, packing
+
+    def _bands_in_threads(self, wfr_files_p, rr, cc, window=None):
+        """
+        Read every band with a thread pool sharing one bounded pool of open Dataset handles.
+        Returns {nc_band: (packed values, band_packing)}
+        """
+        bands = {}
+        window_pixels = self._window_pixels(rr, cc, window)
+        with DatasetPool(max_open=self.max_open_files) as pool:
+
+            def reader(nc_file, nc_band, band_window):
+                values, packing = pool.read_raw_window(nc_file, nc_band, band_window)
+                if nc_band in self.keep_bands:
+                    self.band_windows[nc_band] = self._masked_window(values, packing)
+                return values, packing
+
+            with borrow_executor(self.executor, concurrent.futures.ThreadPoolExecutor) as executor:
+                futures = [self._submit(executor, window_pixels, self._gather_band,
+                                        file_n_band, rr, cc, window, reader)
+                           for file_n_band in wfr_files_p]
+                for (nc_file, nc_band), future in zip(wfr_files_p, futures):
+                    bands[nc_band] = future.result()
+        return bands
+
+    def _bands_in_processes(self, wfr_files_p, rr, cc, window=None):
+        """
+        Read every band with a process pool. rr, cc go to the workers and the band values come back through
+        shared memory, each task only carries the handles.
+        """
+        bands = {}
+        list_of_bands = None
+        # Every band gets 8 bytes per pixel, enough for any of its dtypes.
+        n_files = len(wfr_files_p)
+        shared_pixels = SharedArray.from_array(np.vstack((rr, cc)))
+        shared_outs = [SharedArray((len(rr) * 8,), np.uint8) for _ in range(n_files)]
+
+        try:
+            with borrow_executor(self.executor, concurrent.futures.ProcessPoolExecutor) as executor:
+                try:
+                    window_pixels = self._window_pixels(rr, cc, window)
+                    futures = [self._submit(executor, window_pixels, self._get_band_in_shm,
+                                            file_n_band, shared_pixels.handle, out.handle, window)
+                               for file_n_band, out in zip(wfr_files_p, shared_outs)]
+                    list_of_bands = [future.result() for future in futures]
+                except concurrent.futures.process.BrokenProcessPool as ex:
+                    self.log.info(f"{ex} This might be caused by limited system resources. "
+                                  f"Reading the remaining bands of this product with threads.")
+                    self.backend, self.executor, self.pool_broken = 'thread', None, True
+
+            # For every returned (band, dtype, packing), read its packed values from the shared output
+            for (key, dtype, packing), out in zip(list_of_bands or [], shared_outs):
+                bands[key] = out.array.view(dtype)[:len(rr)].copy(), packing
+        finally:
+            shared_pixels.release()
+            for out in shared_outs:
+                out.release()
+        if self.pool_broken:
+            return self._bands_in_threads(wfr_files_p, rr, cc, window)
+        return bands
+
+    def _read_bands(self, wfr_files_p, rr, cc, window=None):
+        # Checked on every call, a broken process pool switches the rest of the product to threads
+        if self.backend == 'process':
+            return self._bands_in_processes(wfr_files_p, rr, cc, window)
+        return self._bands_in_threads(wfr_files_p, rr, cc, window)
+
+    def nc_2_df(self, rr, cc, oaa, oza, saa, sza, lon, lat, nc_folder, wfr_files_p, parent_log=None, window=None,
+                pushdown=False):
         """
         Given an input polygon and image, return a dataframe containing
         the data of the image that falls inside the polygon.
+        Same arguments as nc_2_batch, whose PixelBatch is converted into the dataframe.
+        """
+        return self.nc_2_batch(rr, cc, oaa, oza, saa, sza, lon, lat, nc_folder, wfr_files_p, parent_log=parent_log,
+                               window=window, pushdown=pushdown).to_pandas()
+
+    def nc_2_batch(self, rr, cc, oaa, oza, saa, sza, lon, lat, nc_folder, wfr_files_p, parent_log=None, window=None,
+                   pushdown=False):
+        """
+        Read every band of wfr_files_p at the rr, cc pixels into a PixelBatch.
+        If a window (row_min, row_max, col_min, col_max) enclosing rr, cc is given,
+        only this hyperslab is read from each NetCDF band.
+        oaa, oza, saa, sza, lon and lat can either be full resolution grids or 1-D arrays already sampled at rr, cc.
+        The bands are read packed and unpacked into float32, the pixels with nodata Oa08 are marked as invalid.
+        With pushdown=True the pushdown_bands are read first and the pixels failing the nodata, saturation and
+        WQSF keep/remove rules are dropped before gathering the other bands (see _pushdown).
         """
         if parent_log:
             self.log = logging.getLogger(name=parent_log)
 
         wfr_files_p = [(os.path.join(nc_folder, nc_file), nc_band) for nc_file, nc_band in wfr_files_p]
+        read_bands = self._read_bands
 
-        # Generate initial df
-        custom_subset = {'x': rr, 'y': cc}
-        df = pd.DataFrame(custom_subset)
-        df['lat'] = [lat[x, y] for x, y in zip(df['x'], df['y'])]
-        df['lon'] = [lon[x, y] for x, y in zip(df['x'], df['y'])]
-        df['OAA'] = [oaa[x, y] for x, y in zip(df['x'], df['y'])]
-        df['OZA'] = [oza[x, y] for x, y in zip(df['x'], df['y'])]
-        df['SAA'] = [saa[x, y] for x, y in zip(df['x'], df['y'])]
-        df['SZA'] = [sza[x, y] for x, y in zip(df['x'], df['y'])]
-
-        cores = utils.get_available_cores()
-        # Populate the initial DF with the output from the other bands
-        with concurrent.futures.ProcessPoolExecutor(max_workers=cores) as executor:
-            try:
-                list_of_bands = list(executor.map(
-                    self._get_band_in_nc, wfr_files_p,
-                    [rr] * len(wfr_files_p),
-                    [cc] * len(wfr_files_p)
-                ))
-            except concurrent.futures.process.BrokenProcessPool as ex:
-                self.log.info(f"{ex} This might be caused by limited system resources. "
-                              f"Try increasing system memory or disable concurrent processing. ")
-
-        # For every returned dict inside the list, grab only the Key and append it at the final DF
-        for b in list_of_bands:
-            for key, val in b.items():
-                df[key] = val
-
-        # DROP NODATA
-        idx_names = df[df['Oa08_reflectance'] == 65535.0].index
-        df.drop(idx_names, inplace=True)
-        return df
+        rr, cc = np.asarray(rr), np.asarray(cc)
+        columns = {}
+        for name, angle in (('lat', lat), ('lon', lon), ('OAA', oaa), ('OZA', oza), ('SAA', saa), ('SZA', sza)):
+            columns[name] = angle if np.ndim(angle) == 1 else angle[rr, cc]
+
+        if pushdown:
+            return self._pushdown(read_bands, columns, rr, cc, wfr_files_p, window)
+
+        bands = read_bands(wfr_files_p, rr, cc, window)
+        for nc_band, (values, packing) in bands.items():
+            columns[nc_band] = unpack_band(values, packing)
+
+        # DROP NODATA: pixels whose packed Oa08 is its _FillValue
+        return PixelBatch(rr, cc, columns, valid=self._valid_pixels(bands))
+
+    # Bands read first by nc_2_df(pushdown=True), to decide which pixels are worth gathering from the others
+    pushdown_bands = ('WQSF', 'Oa08_reflectance', 'Oa01_reflectance')
+
+    @staticmethod
+    def _valid_pixels(bands):
+        oa08, oa08_packing = bands['Oa08_reflectance']
+        if oa08_packing['_FillValue'] is not None:
+            return oa08 != oa08_packing['_FillValue']
+        return np.ones(len(oa08), dtype=bool)
+
+    def _pushdown(self, read_bands, columns, rr, cc, wfr_files_p, window=None):
+        """
+        Read the pushdown_bands, drop the nodata and saturated pixels, count the remaining ones into ABSVLDPX (as
+        TsGenerator.update_df would) and drop the pixels failing the WQSF keep/remove rules. Only the surviving
+        pixels are gathered from the other bands, over the window enclosing them.
+        absvld_index keeps the positions in rr, cc of the pixels counted in ABSVLDPX.
+        """
+        # The kept bands (RGB) are also read first, so their windows cover the whole ROI
+        first = [file_n_band for file_n_band in wfr_files_p
+                 if file_n_band[1] in self.pushdown_bands or file_n_band[1] in self.keep_bands]
+        bands = read_bands(first, rr, cc, window)
+
+        valid = self._valid_pixels(bands)
+        oa01, oa01_packing = bands['Oa01_reflectance']
+        valid &= unpack_band(oa01, oa01_packing) != np.float32(dd.wfr_oa01_saturation)
+        self.absvld_index = np.flatnonzero(valid)
+
+        valid &= utils.wqsf_quality(bands['WQSF'][0])
+        keep = np.flatnonzero(valid)
+        self.log.info(f'Push-down kept {len(keep)} of {len(rr)} pixels ({len(self.absvld_index)} valid).')
+
+        rest = [file_n_band for file_n_band in wfr_files_p if file_n_band[1] not in bands]
+        if len(keep):
+            k_rr, k_cc = rr[keep], cc[keep]
+            k_window = (int(k_rr.min()), int(k_rr.max()) + 1, int(k_cc.min()), int(k_cc.max()) + 1)
+            rest_bands = read_bands(rest, k_rr, k_cc, k_window)
+        else:
+            rest_bands = {nc_band: (np.empty(0, dtype=np.uint16), {'_FillValue': None, 'scale_factor': 1.0,
+                                                                   'add_offset': None})
+                          for _, nc_band in rest}
+
+        columns = {name: values[keep] for name, values in columns.items()}
+        for _, nc_band in wfr_files_p:
+            if nc_band in rest_bands:
+                values, packing = rest_bands[nc_band]
+            else:
+                values, packing = bands[nc_band][0][keep], bands[nc_band][1]
+            columns[nc_band] = unpack_band(values, packing)
+        columns['ABSVLDPX'] = np.full(len(keep), len(self.absvld_index), dtype=np.int64)
+
+        return PixelBatch(rr[keep], cc[keep], columns, index=keep)
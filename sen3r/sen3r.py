@@ -1,15 +1,19 @@
 import os
 import sys
 import time
+import concurrent.futures
+import numpy as np
 import pandas as pd
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
 
 import openpyxl
 from openpyxl.styles import PatternFill
 
-from sen3r.commons import Utils, DefaultDicts, Footprinter
-from sen3r.nc_engine import NcEngine, ParallelBandExtract
+from sen3r.commons import Utils, DefaultDicts, Footprinter, GeoCache, MemoryBudget, PixelStore, ZippedProduct, \
+    CamsTable, pq
+from sen3r.nc_engine import NcEngine, ParallelBandExtract, RoiMask, warm_up_worker
 from sen3r.tsgen import TsGenerator
 
 
@@ -31,20 +35,92 @@ class Core:
         self.INPUT_DIR = self.arguments['input']
         self.OUTPUT_DIR = self.arguments['out']
         Path(self.OUTPUT_DIR).mkdir(parents=True, exist_ok=True)  # Assure the existence of an output folder for the LOG
-        self.ROI = self.arguments['roi']
-        self.RNAME = os.path.basename(self.ROI.split('.')[0])  # Take the ROI without the file extension.
+        # One or several ROIs, the first one is the main ROI of the single ROI methods.
+        roi = self.arguments['roi']
+        self.ROIS = list(roi) if isinstance(roi, (list, tuple)) else [roi]
+        self.ROI = self.ROIS[0]
+        self.RNAMES = [os.path.basename(r.split('.')[0]) for r in self.ROIS]  # Take the ROI without the file extension.
+        self.RNAME = self.RNAMES[0]
+        self.multi_roi = len(self.ROIS) > 1
         self.product = self.arguments['product']
         self.CSV_N1 = os.path.join(self.OUTPUT_DIR, 'CSV_N1')
         self.REP = os.path.join(self.OUTPUT_DIR, 'RDATA')
         self.INSTANCE_TIME_TAG = datetime.now().strftime('%Y%m%dT%H%M%S')
         self.arguments['logfile'] = os.path.join(self.arguments['out'], 'sen3r_' + self.INSTANCE_TIME_TAG + '.log')
         self.log = Utils.create_log_handler(self.arguments['logfile'])
+        # Every ROI is written to OUTPUT/<roi name>, two ROIs with the same file name would overwrite each other.
+        duplicated = sorted({rname for rname in self.RNAMES if self.RNAMES.count(rname) > 1})
+        if duplicated:
+            self.log.info(f'Several ROIs share the name {", ".join(duplicated)}, please rename their files.')
+            sys.exit(1)
         self.IMG_DIR = os.path.join(self.OUTPUT_DIR, 'images')
         # Section 5 for single source of truth for the version number:
         # https://packaging.python.org/guides/single-sourcing-package-version/#single-sourcing-the-version
         self.VERSION = metadata.version('sen3r')  # TODO: May be outdated depending on the environment installed version
         self.vertices = None  # Further declaration may happen inside build_intermediary_files
+        self.roi_vertices = {}  # {rname: vertices} of every ROI, declared inside build_raw_csvs
         self.sorted_file_list = None  # Declaration may happen inside build_intermediary_files
+        # Optional on-disk cache of the vertices/pixels found for each product, reused by reprocessing runs.
+        self.geo_cache = None
+        if self.arguments.get('cache'):
+            self.geo_cache = GeoCache(cache_dir=self.arguments['cache'],
+                                      max_size_mb=self.arguments.get('cache_size') or 1024,
+                                      parent_log=self.log)
+        # Worker pool shared by every product of a build_raw_csvs run, see start_workers.
+        self.executor = None
+        # Memory admission of the products and band reads, from the container limits and --max-memory.
+        self.budget = MemoryBudget(max_memory_mb=self.arguments.get('max_memory'), parent_log=self.log)
+        # Format of the intermediate CSV_N1/CSV_N2 pixel files, see Utils.write_pixels.
+        pixel_format = self.arguments.get('format') or 'csv'
+        if pixel_format not in Utils.pixel_formats:
+            self.log.info(f'Invalid intermediate format: {pixel_format}.')
+            sys.exit(1)
+        if pixel_format == 'parquet' and pq is None:
+            self.log.info('Unable to import pyarrow, required by --format parquet.')
+            sys.exit(1)
+        self.pixel_ext = Utils.pixel_formats[pixel_format]
+        # Optional partitioned Parquet store of the pixels of every product and ROI, filled by build_raw_csvs.
+        self.pixel_store = None
+        if self.arguments.get('store'):
+            if pq is None:
+                self.log.info('Unable to import pyarrow, required by --store.')
+                sys.exit(1)
+            self.pixel_store = PixelStore(store_dir=self.arguments['store'], parent_log=self.log)
+        # CAMS AOD865 time series, loaded once by the first process_csv_list using it.
+        self.cams_table = None
+
+    def start_workers(self, initializer=warm_up_worker, initargs=()):
+        """
+        Create the worker pool used by every product of the run, so the workers start (and import their
+        dependencies) only once. Its kind follows --band-reader and its size --workers.
+        Worker processes run initializer(*initargs) when they start, see nc_engine.warm_up_worker.
+        """
+        workers = self.arguments.get('workers') or Utils(parent_log=self.log).get_available_cores()
+        if self.arguments.get('band_reader') != 'thread':
+            workers = self.budget.max_tasks(MemoryBudget.process_overhead, workers)
+            self.log.info(f'Starting a pool of {workers} worker processes.')
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                                   **_pool_init(initializer, initargs))
+        else:
+            self.log.info(f'Starting a pool of {workers} worker threads.')
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        return self.executor
+
+    def stop_workers(self):
+        """
+        Shut down the worker pool created by start_workers.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def __getstate__(self):
+        # The worker pool can not travel to the product workers of build_raw_csvs, they use their own threads.
+        # Neither can the memory budget, the footprint of the whole product is reserved before submitting it.
+        state = self.__dict__.copy()
+        state['executor'] = None
+        state['budget'] = None
+        return state
 
     @staticmethod
     def build_list_from_subset(input_directory_path):
@@ -59,71 +135,158 @@ class Core:
 
         return sorted_output_files_fullpath
 
-    def get_s3_data(self, wfr_img_folder, vertices=None, roi_file=None, rgb=True, parallel=True):
+    def roi_dir(self, rname=None, sub_dir=None):
         """
-        Given a vector and a S3_OL2_WFR image, extract the NC data inside the vector.
+        Output folder of a ROI: OUTPUT_DIR itself for a single ROI run, OUTPUT_DIR/<rname> when several ROIs are
+        extracted at once. sub_dir (i.e. 'CSV_N1') is appended if given.
         """
-        img_data = {}
-        img = wfr_img_folder
-        process_flag = True
+        out = os.path.join(self.OUTPUT_DIR, rname) if self.multi_roi and rname else self.OUTPUT_DIR
+        return os.path.join(out, sub_dir) if sub_dir else out
 
-        # Test if there is a footprint.shp file inside the image folder
+    def _touches_footprint(self, img, roi_file):
+        """
+        Test if the footprint.shp inside the image folder (when there is one) touches the user ROI.
+        """
         footprint = Path(img) / 'footprint.shp'
         if footprint.is_file():
             self.log.info('footprint.shp found inside image folder.')
-            # Test if the footprint.shp touches the user ROI
             if not Footprinter.touch_test(footprint, roi_file):
                 # If touch_test returns False the ROI don't touch and the image can be skipped
-                process_flag = False
-            else:
-                self.log.info('User ROI touches footprint.shp, processing will continue.')
+                return False
+            self.log.info('User ROI touches footprint.shp, processing will continue.')
+        return True
 
-        if process_flag:
-            # Class instance of NcEngine containing information about all the bands.
-            nce = NcEngine(input_nc_folder=img, parent_log=self.log)
+    def _locate_roi(self, nce, vertices, windowed=True):
+        """
+        Convert the ROI LAT/LON vertices into X,Y vertices and the RoiMask of its pixels in the product of nce.
+        """
+        img_data = {}
+        # Convert the input ROI LAT/LON vertices to X,Y coordinates based on the geo_coordinates.nc file
+        cached = self.geo_cache.get(nce.nc_base_name, vertices) if self.geo_cache else None
+        if cached:
+            self.log.info(f'Geolocation cache hit for: {nce.nc_base_name}')
+            img_data['xy_vert'], img_data['ll_vert'] = cached['xy_vert'], vertices
+            img_data['mask'] = nce.get_pixels_mask(rr=cached['rr'], cc=cached['cc'],
+                                                   window=nce.get_roi_window(xy_vertices=img_data['xy_vert']))
+            img_data['rr'], img_data['cc'] = img_data['mask'].rr, img_data['mask'].cc
+        else:
+            # Windowed extraction pairs with the tie point locator, that never loads the full lat/lon arrays.
+            img_data['xy_vert'], img_data['ll_vert'] = nce.latlon_2_xy_poly(poly_path=vertices,
+                                                                             locator='tie' if windowed else 'kdtree')
+
+            # II) Use the poly to generate an extraction mask, bounded to the ROI window and without duplicates:
+            img_data['mask'], img_data['cc'], img_data['rr'] = nce.get_raster_mask(
+                xy_vertices=img_data['xy_vert'])
+
+            if self.geo_cache:
+                self.geo_cache.put(nce.nc_base_name, vertices, img_data['xy_vert'], img_data['rr'], img_data['cc'])
+        return img_data
+
+    def _skip_reason(self, water, rname=None):
+        """
+        Given the WQSF test of the ROI pixels (see NcEngine.water_pixels), return why the product should not be
+        extracted, or None if it has at least --min-valid % of valid water pixels.
+        """
+        min_valid = self.arguments.get('min_valid')
+        pct = 100 * np.count_nonzero(water) / len(water) if len(water) else 0.0
+        if pct >= min_valid:
+            return None
+        reason = f'Skipped: {pct:.2f}% of valid water pixels (< {min_valid}%).'
+        self.log.info(f'WARNING: DATAFRAME SKIPPED! {rname or self.RNAME} - {reason}')
+        return reason
+
+    def _check_water(self):
+        # The cloud pre-check relies on the WQSF flags, only available for WFR.
+        return self.arguments.get('min_valid') is not None and self.product.lower() == 'wfr'
+
+    def _extract_pixels(self, nce, img_data, windowed=True, rgb=False):
+        """
+        Read every band of the product of nce at the img_data['rr'], img_data['cc'] pixels.
+        Fills img_data with the bands dictionary, lat/lon and angles and returns the PixelBatch of the pixels.
+        With rgb=True the windows of the RGB bands are kept in img_data['band_windows'] for the quicklooks.
+        """
+        img_data['window'] = img_data['mask'].window if windowed else None
+
+        # III) Get the dictionary of available bands based on the product:
+        if self.product and self.product.lower() == 'wfr':
+            img_data['bdict'] = dd.wfr_files
+        elif self.product and self.product.lower() == 'syn':
+            img_data['bdict'] = dd.syn_files
+        else:
+            self.log.info(f'Invalid product: {self.product.upper()}.')
+            sys.exit(1)
+
+        if windowed:
+            img_data['g_lat'], img_data['g_lon'] = nce.sample_latlon(rr=img_data['rr'], cc=img_data['cc'],
+                                                                     window=img_data['window'])
+        else:
+            img_data['g_lon'] = nce.g_lon
+            img_data['g_lat'] = nce.g_lat
+        # Sun and observation angles interpolated only at the extracted pixels.
+        img_data.update(nce.sample_geometries(rr=img_data['rr'], cc=img_data['cc']))
+        img_data['nc_file'] = nce.nc_folder
+
+        # IV) Extract the data from the NetCDF using the mask
+        rgb_bands = [nc_band for _, nc_band in nce.rgb_bands.get(nce.product, ())] if rgb else ()
+        pbe = ParallelBandExtract(backend=self.arguments.get('band_reader') or 'process', executor=self.executor,
+                                  budget=self.budget, keep_bands=rgb_bands)
+        batch = pbe.nc_2_batch(rr=img_data['rr'], cc=img_data['cc'],
+                               lon=img_data['g_lon'],
+                               lat=img_data['g_lat'],
+                               oaa=img_data['OAA'],
+                               oza=img_data['OZA'],
+                               saa=img_data['SAA'],
+                               sza=img_data['SZA'],
+                               nc_folder=img_data['nc_file'],
+                               wfr_files_p=dd.wfr_files_p,
+                               parent_log=self.arguments['logfile'],
+                               window=img_data['window'],
+                               pushdown=bool(self.arguments.get('pushdown')) and self.product.lower() == 'wfr')
+        img_data['absvld_index'] = pbe.absvld_index
+        if pbe.pool_broken and self.executor is not None:
+            # Do not hand the broken pool to the next products.
+            self.log.info('Restarting the worker pool.')
+            self.stop_workers()
+            self.start_workers()
+        if rgb:
+            img_data['band_windows'] = pbe.band_windows
+
+        return batch
+
+    def _pixels_df(self, batch):
+        """
+        DataFrame of the valid pixels of batch, with the column names of the product.
+        """
+        if self.product.lower() == 'wfr':
+            return batch.to_pandas(names=dd.wfr_vld_names)
 
-            # Convert the input ROI LAT/LON vertices to X,Y coordinates based on the geo_coordinates.nc file
-            img_data['xy_vert'], img_data['ll_vert'] = nce.latlon_2_xy_poly(poly_path=vertices)
+        # TODO: check necessity of renaming SYNERGY colnames.
+        # if self.product.lower() == 'syn':
+        #     return batch.to_pandas(names=self.syn_vld_names)
 
-            # II) Use the poly to generate an extraction mask:
-            img_data['mask'], img_data['cc'], img_data['rr'] = nce.get_raster_mask(xy_vertices=img_data['xy_vert'])
+        return batch.to_pandas()
 
-            # III) Get the dictionary of available bands based on the product:
-            if self.product and self.product.lower() == 'wfr':
-                img_data['bdict'] = dd.wfr_files
-            elif self.product and self.product.lower() == 'syn':
-                img_data['bdict'] = dd.syn_files
-            else:
-                self.log.info(f'Invalid product: {self.product.upper()}.')
-                sys.exit(1)
+    def get_s3_data(self, wfr_img_folder, vertices=None, roi_file=None, rgb=True, parallel=True, windowed=True):
+        """
+        Given a vector and a S3_OL2_WFR image, extract the NC data inside the vector.
+        When windowed is True, only the hyperslab enclosing the ROI is read from the NetCDF bands.
+        """
+        img_data = {}
+        img = wfr_img_folder
 
-            img_data['g_lon'] = nce.g_lon
-            img_data['g_lat'] = nce.g_lat
-            img_data['OAA'] = nce.OAA
-            img_data['OZA'] = nce.OZA
-            img_data['SAA'] = nce.SAA
-            img_data['SZA'] = nce.SZA
-            img_data['nc_file'] = nce.nc_folder
-
-            # IV) Extract the data from the NetCDF using the mask
-            pbe = ParallelBandExtract()
-            df = pbe.nc_2_df(rr=img_data['rr'], cc=img_data['cc'],
-                             lon=img_data['g_lon'],
-                             lat=img_data['g_lat'],
-                             oaa=img_data['OAA'],
-                             oza=img_data['OZA'],
-                             saa=img_data['SAA'],
-                             sza=img_data['SZA'],
-                             nc_folder=img_data['nc_file'],
-                             wfr_files_p=dd.wfr_files_p,
-                             parent_log=self.arguments['logfile'])
-
-            if self.product.lower() == 'wfr':
-                df = df.rename(columns=dd.wfr_vld_names)
-
-            # TODO: check necessity of renaming SYNERGY colnames.
-            # if self.product.lower() == 'syn':
-            #     df = df.rename(columns=self.syn_vld_names)
+        if self._touches_footprint(img, roi_file):
+            # Class instance of NcEngine containing information about all the bands.
+            nce = NcEngine(input_nc_folder=img, parent_log=self.log, executor=self.executor)
+
+            img_data.update(self._locate_roi(nce, vertices, windowed))
+            if self._check_water():
+                img_data['skipped'] = self._skip_reason(nce.water_pixels(img_data['mask']))
+                if img_data['skipped']:
+                    # Same keys as an extracted product, without the quicklook.
+                    img_data['colors'] = dict.fromkeys(['red', 'green', 'blue'])
+                    img_data['img'] = None
+                    return pd.DataFrame(columns=list(dd.wfr_vld_names.values())), img_data
+            df = self._pixels_df(self._extract_pixels(nce, img_data, windowed, rgb))
 
             if len(df) == 0:
                 self.log.info('EMPTY DATAFRAME WARNING! Unable to find valid pixels in file.')
@@ -131,8 +294,12 @@ class Core:
             img_data['colors'] = {}
             img_data['img'] = None
             if rgb:
+                # Built from the band windows already read by the extraction, when they are available.
                 img_data['colors']['red'], img_data['colors']['green'], img_data['colors']['blue'], img_data[
-                    'img'] = nce.get_rgb_from_poly(xy_vertices=img_data['xy_vert'])
+                    'img'] = nce.get_rgb_from_poly(xy_vertices=img_data['xy_vert'],
+                                                   band_windows=img_data.pop('band_windows'),
+                                                   window=img_data['window'],
+                                                   max_size=self.arguments.get('rgb_max_size'))
 
             return df, img_data
 
@@ -141,46 +308,222 @@ class Core:
         df = pd.DataFrame(columns=list(dd.wfr_vld_names.values()))
         return df, img_data
 
+    def get_s3_multi_data(self, wfr_img_folder, rois, roi_files=None, rgb=False, windowed=True):
+        """
+        Same as get_s3_data, for several ROIs at once: rois is a dict {rname: vertices}.
+        The ROI masks are merged into a single labeled mask, so every band of the product is read only once, and
+        the pixels are then scattered into one DataFrame per ROI.
+        :return: dict {rname: (df, img_data)}
+        """
+        roi_files = roi_files or {}
+        img = wfr_img_folder
+        results = {}
+        nce = None
+        located = {}
+        for rname, vertices in rois.items():
+            if not self._touches_footprint(img, roi_files.get(rname)):
+                self.log.info(f'WARNING: DATAFRAME SKIPPED! {rname} does not touch footprint.shp coordinates.')
+                results[rname] = (pd.DataFrame(columns=list(dd.wfr_vld_names.values())), {})
+                continue
+            if nce is None:
+                nce = NcEngine(input_nc_folder=img, parent_log=self.log, executor=self.executor)
+            located[rname] = self._locate_roi(nce, vertices, windowed)
+
+        if located and self._check_water():
+            # A single WQSF read over all the ROIs, the cloudy ones are left out of the extraction.
+            union, members = RoiMask.union([img_data['mask'] for img_data in located.values()])
+            water = nce.water_pixels(union)
+            for (rname, img_data), positions in zip(list(located.items()), members):
+                img_data['skipped'] = self._skip_reason(water[positions], rname)
+                if img_data['skipped']:
+                    img_data['colors'] = dict.fromkeys(['red', 'green', 'blue'])
+                    img_data['img'] = None
+                    results[rname] = (pd.DataFrame(columns=list(dd.wfr_vld_names.values())), located.pop(rname))
+
+        if located:
+            union, members = RoiMask.union([img_data['mask'] for img_data in located.values()])
+            union_data = {'mask': union, 'rr': union.rr, 'cc': union.cc}
+            batch = self._extract_pixels(nce, union_data, windowed, rgb)
+
+            for (rname, img_data), positions in zip(located.items(), members):
+                # Only the validity mask differs between the ROIs, batch.index are the positions in the union.
+                roi_df = self._pixels_df(batch.where(np.isin(batch.index, positions))).reset_index(drop=True)
+                if 'ABSVLDPX' in roi_df:
+                    # The push-down count covers the whole union, recount the pixels of this ROI
+                    roi_df['ABSVLDPX'] = np.isin(positions, union_data['absvld_index']).sum()
+                if len(roi_df) == 0:
+                    self.log.info(f'EMPTY DATAFRAME WARNING! Unable to find valid pixels of {rname} in file.')
+                img_data['colors'] = {}
+                img_data['img'] = None
+                if rgb:
+                    img_data['colors']['red'], img_data['colors']['green'], img_data['colors']['blue'], img_data[
+                        'img'] = nce.get_rgb_from_poly(xy_vertices=img_data['xy_vert'],
+                                                       band_windows=union_data['band_windows'],
+                                                       window=union_data['window'],
+                                                       max_size=self.arguments.get('rgb_max_size'))
+                results[rname] = (roi_df, img_data)
+
+        return {rname: results[rname] for rname in rois}
+
     def build_raw_csvs(self):
         """
         Parse the input arguments and return a path containing the output intermediary files.
-        :return: l1_output_path Posixpath
+        When several ROIs were given, every product is read once for all of them (see get_s3_multi_data).
+        :return: list of the written CSVs, or a dict {rname: list of CSVs} when several ROIs were given.
         """
         self.log.info(f'Searching for WFR files inside: {self.INPUT_DIR}')
         self.log.info('Sorting input files by date.')
         self.sorted_file_list = self.build_list_from_subset(input_directory_path=self.INPUT_DIR)
         self.log.info(f'Input files found: {len(self.sorted_file_list)}')
         self.log.info('------')
-        self.log.info(f'Generating ancillary data folder: {self.CSV_N1}')
-        Path(self.CSV_N1).mkdir(parents=True, exist_ok=True)
-        self.log.info(f'Generating report folder: {self.REP}')
-        Path(self.REP).mkdir(parents=True, exist_ok=True)
-        self.log.info(f'Attempting to extract geometries from: {self.ROI}')
-        self.vertices = Utils.roi2vertex(roi=self.ROI, aux_folder_out=self.CSV_N1)
+        for rname, roi in zip(self.RNAMES, self.ROIS):
+            csv_n1, rep = self.roi_dir(rname, 'CSV_N1'), self.roi_dir(rname, 'RDATA')
+            self.log.info(f'Generating ancillary data folder: {csv_n1}')
+            Path(csv_n1).mkdir(parents=True, exist_ok=True)
+            self.log.info(f'Generating report folder: {rep}')
+            Path(rep).mkdir(parents=True, exist_ok=True)
+            self.log.info(f'Attempting to extract geometries from: {roi}')
+            self.roi_vertices[rname] = Utils.roi2vertex(roi=roi, aux_folder_out=csv_n1)
+        self.vertices = self.roi_vertices[self.RNAME]
 
         total = len(self.sorted_file_list)
         t1 = time.perf_counter()
-        done_csvs = []
-        for n, img in enumerate(self.sorted_file_list):
-            percent = int((n * 100) / total)
-            figdate = os.path.basename(img).split('____')[1].split('_')[0]
-            self.log.info(f'({percent}%) {n + 1} of {total} - {figdate}')
+        in_flight = self.arguments.get('products_in_flight') or 1
+        if in_flight > 1:
+            done_csvs = self._extract_products_in_flight(total, in_flight)
+        else:
+            self.start_workers()
             try:
-                band_data, img_data = self.get_s3_data(wfr_img_folder=img, vertices=self.vertices, roi_file=self.ROI)
-                f_b_name = os.path.basename(img).split('.')[0]
-                out_dir = os.path.join(self.CSV_N1, f_b_name + '.csv')
-                self.log.info(f'Saving DF at : {out_dir}')
-                band_data.to_csv(out_dir, index=False)
-                done_csvs.append(out_dir)
-            except FileNotFoundError as e404:
-                # If some Band.nc file was missing inside the image, move to the next one.
-                self.log.info(f'{e404}')
-                self.log.info(f'Skipping: {figdate}')
-                continue
+                done_csvs = self._extract_products(total)
+            finally:
+                self.stop_workers()
 
         t2 = time.perf_counter()
         outputstr = f'>>> Finished in {round(t2 - t1, 2)} second(s). <<<'
         self.log.info(outputstr)
+        return done_csvs if self.multi_roi else done_csvs[self.RNAME]
+
+    def open_product(self, img):
+        """
+        Context manager yielding the .SEN3 folder of the product img. Zipped products are not unpacked, only the
+        files needed by the extraction are taken out of the .zip into a temporary folder (see --unzip-dir).
+        """
+        if not ZippedProduct.is_zip(img):
+            return _unchanged(img)
+        members = None
+        if self.product and self.product.lower() == 'wfr':
+            members = [nc_file for nc_file, _ in dd.wfr_files_p] + list(dd.wfr_aux_files)
+        return ZippedProduct(img, members=members, tmp_dir=self.arguments.get('unzip_dir'), parent_log=self.log)
+
+    def extract_product(self, img):
+        """
+        Extract a single product (.SEN3 folder or .zip) into its own CSV inside the CSV_N1 folder of every ROI.
+        :return: dict {rname: path of the CSV}, empty if the product was skipped.
+        """
+        figdate = os.path.basename(img).split('____')[1].split('_')[0]
+        try:
+            with self.open_product(img) as sen3_folder:
+                if self.multi_roi:
+                    results = self.get_s3_multi_data(wfr_img_folder=sen3_folder, rois=self.roi_vertices,
+                                                     roi_files=dict(zip(self.RNAMES, self.ROIS)))
+                else:
+                    results = {self.RNAME: self.get_s3_data(wfr_img_folder=sen3_folder, vertices=self.vertices,
+                                                            roi_file=self.ROI)}
+            f_b_name = os.path.basename(img).split('.')[0]
+            done = {}
+            for rname, (band_data, img_data) in results.items():
+                out_dir = os.path.join(self.roi_dir(rname, 'CSV_N1'), f_b_name + self.pixel_ext)
+                self.log.info(f'Saving DF at : {out_dir}')
+                Utils.write_pixels(band_data, out_dir)
+                self.write_skip_record(out_dir, img_data.get('skipped'))
+                if self.pixel_store:
+                    self.pixel_store.append(band_data, rname, f_b_name)
+                done[rname] = out_dir
+            return done
+        except FileNotFoundError as e404:
+            # If some Band.nc file was missing inside the image, move to the next one.
+            self.log.info(f'{e404}')
+            self.log.info(f'Skipping: {figdate}')
+            return {}
+
+    @staticmethod
+    def write_skip_record(csv_path, reason=None):
+        """
+        Keep the reason why the product of csv_path was not extracted next to its (empty) CSV, so process_csv_list
+        can report the date as skipped. Any previous record of a product that is now extracted is removed.
+        """
+        skip_path = os.path.splitext(csv_path)[0] + '.skip'
+        if reason:
+            with open(skip_path, 'w') as f:
+                f.write(reason)
+        elif os.path.exists(skip_path):
+            os.remove(skip_path)
+
+    @staticmethod
+    def read_skip_record(csv_path):
+        skip_path = os.path.splitext(csv_path)[0] + '.skip'
+        if not os.path.exists(skip_path):
+            return None
+        with open(skip_path) as f:
+            return f.read().strip()
+
+    def _extract_products(self, total):
+        """
+        Extract every product of self.sorted_file_list, one after the other.
+        :return: dict {rname: list of the written CSVs}
+        """
+        done_csvs = {rname: [] for rname in self.RNAMES}
+        for n, img in enumerate(self.sorted_file_list):
+            percent = int((n * 100) / total)
+            figdate = os.path.basename(img).split('____')[1].split('_')[0]
+            self.log.info(f'({percent}%) {n + 1} of {total} - {figdate}')
+            for rname, out_dir in self.extract_product(img).items():
+                done_csvs[rname].append(out_dir)
+
+        return done_csvs
+
+    def _grid_shape(self, img):
+        if ZippedProduct.is_zip(img):
+            # Not worth unzipping the geolocation just for the estimate, the ROI window dominates it anyway.
+            return MemoryBudget.olci_grid_shape
+        return NcEngine.read_grid_shape(img, product=self.product)
+
+    def _extract_products_in_flight(self, total, in_flight, initializer=warm_up_worker, initargs=()):
+        """
+        Extract up to in_flight products at the same time, each one in its own worker process and into its own CSV.
+        The results are collected in date order, so done_csvs is the same as in the sequential mode.
+        Worker processes run initializer(*initargs) when they start, see nc_engine.warm_up_worker.
+        """
+        # Estimate the peak memory of each product from its grid dimensions and the size of all the ROIs.
+        band_workers = Utils(parent_log=self.log).get_available_cores()
+        all_vertices = [vert for vertices in self.roi_vertices.values() for vert in vertices]
+        footprints = [MemoryBudget.product_footprint(self._grid_shape(img), all_vertices, band_workers)
+                      for img in self.sorted_file_list]
+        in_flight = self.budget.max_tasks(max(footprints, default=0), in_flight)
+        self.log.info(f'Extracting up to {in_flight} products at the same time.')
+        done_csvs = {rname: [] for rname in self.RNAMES}
+        n = 0
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=in_flight,
+                                                        **_pool_init(initializer, initargs)) as executor:
+                futures = [self.budget.submit(executor, footprint, _extract_product_worker, self, img)
+                           for img, footprint in zip(self.sorted_file_list, footprints)]
+                for img, future in zip(self.sorted_file_list, futures):
+                    done = future.result()
+                    n += 1
+                    percent = int((n * 100) / total)
+                    figdate = os.path.basename(img).split('____')[1].split('_')[0]
+                    self.log.info(f'({percent}%) {n} of {total} - {figdate} done.')
+                    for rname, out_dir in done.items():
+                        done_csvs[rname].append(out_dir)
+        except concurrent.futures.process.BrokenProcessPool as ex:
+            # Most likely a worker was killed for lack of memory, finish the remaining products one at a time.
+            self.log.info(f"{ex} This might be caused by limited system resources. "
+                          f"Extracting the remaining {total - n} products one at a time.")
+            for img in self.sorted_file_list[n:]:
+                for rname, out_dir in self.extract_product(img).items():
+                    done_csvs[rname].append(out_dir)
+
         return done_csvs
 
     def build_single_csv(self, multiFileBridge=False):
@@ -200,14 +543,18 @@ class Core:
 
         # if df is not None:
         f_b_name = os.path.basename(self.INPUT_DIR).split('.')[0]
-        out_dir = os.path.join(self.CSV_N1, f_b_name + '.csv')
+        out_dir = os.path.join(self.CSV_N1, f_b_name + self.pixel_ext)
         self.log.info(f'Saving DF at : {out_dir}')
-        band_data.to_csv(out_dir, index=False)
+        Utils.write_pixels(band_data, out_dir)
+        self.write_skip_record(out_dir, img_data.get('skipped'))
         return band_data, img_data, [out_dir]
 
-    def process_csv_list(self, raw_csv_list, irmin=False, irmax=False, max_aot=False, use_cams=False, do_clustering=True, k_method='M4'):
+    def process_csv_list(self, raw_csv_list, irmin=False, irmax=False, max_aot=False, use_cams=False, do_clustering=True, k_method='M4', rname=None,
+                         flags=False):
         """
 
+        :param flags: keep the human-readable FLAGS column in the CSV_N2 files (see TsGenerator.add_flags_to_df).
+        :param rname: ROI of raw_csv_list when several ROIs were extracted at once, defaults to the main ROI.
         :param max_aot:
         :param k_method:
         :param do_clustering:
@@ -221,11 +568,13 @@ class Core:
         self.tsg = tsgen
 
         # GET SERIES SAVE PATH # TODO: refactor
+        rname = rname or self.RNAME
         safe_version = self.VERSION.replace('.', '-')  # Bad idea to save files with dots in the name
-        excel_save_path = os.path.join(self.OUTPUT_DIR, f'{self.RNAME}_SEN3R-{safe_version}.xlsx')
-        report_save_path = os.path.join(self.OUTPUT_DIR, f'{self.RNAME}_SEN3R-{safe_version}.pdf')
-        out_dir = os.path.join(self.OUTPUT_DIR, 'CSV_N2')
-        img_dir = os.path.join(self.OUTPUT_DIR, 'IMG')
+        excel_save_path = os.path.join(self.roi_dir(rname), f'{rname}_SEN3R-{safe_version}.xlsx')
+        report_save_path = os.path.join(self.roi_dir(rname), f'{rname}_SEN3R-{safe_version}.pdf')
+        funnel_save_path = os.path.join(self.roi_dir(rname), f'{rname}_SEN3R-{safe_version}_funnel.csv')
+        out_dir = self.roi_dir(rname, 'CSV_N2')
+        img_dir = self.roi_dir(rname, 'IMG')
 
         # CREATE THE DIRECTORIES IF THEY DOESN'T EXIST YET
         Path(out_dir).mkdir(parents=True, exist_ok=True)
@@ -240,10 +589,17 @@ class Core:
         # List of report pages
         img_report_list = []
 
+        # {CSV name: reason} of the products skipped by the extraction, reported in the time series
+        skipped = {}
+
         if use_cams:
-            # READ CAMS input .csv file
-            df_cams = pd.read_csv(self.arguments['cams'])
-            df_cams['pydate'] = pd.to_datetime(df_cams['Datetime'])
+            # AOD865 of every image at once, with a single join against the sorted CAMS table
+            if self.cams_table is None:
+                self.cams_table = CamsTable(self.arguments['cams'], parent_log=self.log)
+            img_dates = [datetime.strptime(os.path.basename(img).split('____')[1].split('_')[0], '%Y%m%dT%H%M%S')
+                         for img in raw_csv_list]
+            cams_aod = self.cams_table.lookup(img_dates, match=self.arguments.get('cams_match') or 'noon',
+                                              tolerance=self.arguments.get('cams_tolerance'))
 
         for n, img in enumerate(raw_csv_list):
 
@@ -257,21 +613,21 @@ class Core:
             savpt_rrs = os.path.join(img_dir, figdate + '_2.png')
             savpt_k = os.path.join(img_dir, figdate + '_3.png')
 
-            if use_cams:
-                # Find the equivalent observation day in CAMS
-                dtlbl = datetime.strptime(figdate, '%Y%m%dT%H%M%S')
-                dtlbl = dtlbl.replace(hour=12, minute=0, second=0, microsecond=0)
-                cams_row = df_cams[df_cams['pydate'] == dtlbl]
-                if len(cams_row) < 1:  # if cams_row == 0 no matching date was found in the CAMS.csv file
-                    cams_val = False
-                else:
-                    cams_val = cams_row['AOD865'].values[0]
-
-            else:
+            if use_cams and not np.isnan(cams_aod[n]):
+                cams_val = cams_aod[n]
+            else:  # No matching date was found in the CAMS.csv file
                 cams_val = False
 
+            skip_reason = self.read_skip_record(img)
+            if skip_reason:
+                # Nothing was extracted, only the empty CSV goes to the series.
+                self.log.info(f'{figdate} {skip_reason}')
+                skipped[os.path.basename(img)] = skip_reason
+                tsgen.update_csvs(csv_path=img, savepath=out_dir, flags=flags)
+                continue
+
             # read LV1 CSVs and generate scatter plots
-            rawDf = pd.read_csv(img, sep=',')
+            rawDf = Utils.read_pixels(img)
 
             tsgen.plot_sidebyside_sktr(x1_data=rawDf['Oa08_reflectance:float'],
                                        y1_data=rawDf['Oa17_reflectance:float'],
@@ -289,12 +645,14 @@ class Core:
             # reprocessing the raw CSVs and removing reflectances above the threshold in IR.
             try:
                 dfpth, df = tsgen.update_csvs(csv_path=img,
+                                              raw_df=rawDf.copy(),
                                               glint=20.0,
                                               ir_min_threshold=irmin,
                                               ir_max_threshold=irmax,
                                               savepath=out_dir,
                                               max_aot=max_aot,
-                                              cams_val=cams_val)
+                                              cams_val=cams_val,
+                                              flags=flags)
 
             except Exception as e:
                 self.log.info("type error: " + str(e))
@@ -313,7 +671,7 @@ class Core:
                                               img_id_date=figdate,
                                               raw_df=rawDf,
                                               filtered_df=df,
-                                              output_rprt_path=self.REP)
+                                              output_rprt_path=self.roi_dir(rname, 'RDATA'))
 
                 img_report_list.append(img_report)
             else:
@@ -323,6 +681,7 @@ class Core:
             # | DBSCAN Clustering  |------------------------------------------------------------------------------------
             # '--------------------'
             if do_clustering:
+                t_k, pixels_in = time.perf_counter(), len(df)
                 # Backup the DF before cleaning it with DBSCAN
                 bkpdf = df.copy()
 
@@ -347,6 +706,7 @@ class Core:
 
                 else:
                     df = bkpdf.copy()
+                tsgen.add_funnel_stage(os.path.basename(img), 'dbscan', pixels_in, len(df), t_k)
 
             tsgen.plot_sidebyside_sktr(x1_data=df['Oa08_reflectance:float'],
                                        y1_data=df['Oa17_reflectance:float'],
@@ -374,7 +734,7 @@ class Core:
         todo = tsgen.build_list_from_subset(wdir)
 
         # Converting and saving the list of mean values into a XLS excel file.
-        data = tsgen.generate_tms_data(wdir, todo)
+        data = tsgen.generate_tms_data(wdir, todo, skipped=skipped)
 
         series_df = pd.DataFrame(data=data)
         # Delete these row indexes from dataFrame
@@ -400,6 +760,10 @@ class Core:
         writer.save()
         writer.close()
 
+        # Pixels kept and time spent by every filter of update_df, for each product
+        self.log.info(f'Saving the filter funnel at: {funnel_save_path}')
+        tsgen.funnel_table().to_csv(funnel_save_path, index=False)
+
         # Custom paiting the cells
         # https://openpyxl.readthedocs.io/en/stable/_modules/openpyxl/styles/colors.html
         wb = openpyxl.load_workbook(excel_save_path)
@@ -446,3 +810,28 @@ class Core:
         outputstr = f'>>> Finished in {round(t2 - t1, 2)} second(s). <<<'
         print(outputstr)
         self.log.info(outputstr)
+
+
+def _pool_init(initializer, initargs):
+    # Initializers of the concurrent.futures pools are only available since python 3.7
+    if initializer is None or sys.version_info < (3, 7):
+        return {}
+    return {'initializer': initializer, 'initargs': initargs}
+
+
+@contextmanager
+def _unchanged(value):
+    # contextlib.nullcontext, only available since python 3.7
+    yield value
+
+
+def _extract_product_worker(core, img):
+    """
+    Run Core.extract_product inside a worker process of Core._extract_products_in_flight.
+    """
+    # Workers that were not forked need their own handler to append to the log file of the run.
+    if not core.log.handlers:
+        core.log = Utils.create_log_handler(core.arguments['logfile'])
+    # Band reads inside a worker always use threads, nesting process pools would oversubscribe the node.
+    core.arguments = dict(core.arguments, band_reader='thread')
+    return core.extract_product(img)
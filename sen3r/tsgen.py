@@ -28,6 +28,9 @@ class TsGenerator:
     def __init__(self, parent_log=None):
         # Setting up information logs
         self.log = parent_log
+        # Pixels in/out and elapsed time of every stage of update_df, for each product of update_csvs
+        self.funnel = []
+        self.last_funnel = []
 
     imgdpi = 100
     rcparam = [14, 5.2]
@@ -44,7 +47,7 @@ class TsGenerator:
         else:
             print('Input must be of type int or float.')
             return False
-        if binexval != '11111111111111111111111111111110':
+        if binexval != "{0:b}".format(dd.wfr_false_flags):
             flags = [dd.wfr_bin2flags[n] for n, e in enumerate(binexval[::-1]) if e == '1']
         else:
             return False
@@ -72,10 +75,13 @@ class TsGenerator:
         else:
             return 0
 
+    @staticmethod
+    def nd_index(band1, band2):
+        return (band1 - band2) / (band1 + band2)
+
     @staticmethod
     def calc_nd_index(df, band1, band2, column_name='nd_index'):
-        idx = (df[band1] - df[band2]) / (df[band1] + df[band2])
-        df[column_name] = idx
+        df[column_name] = TsGenerator.nd_index(df[band1], df[band2])
         pass
 
     @staticmethod
@@ -138,126 +144,154 @@ class TsGenerator:
         https://www.sciencedirect.com/science/article/pii/S0034425703001846
         https://doi.org/10.1016/S0034-4257(03)00184-6
         """
-        df['GLINT'] = np.degrees(np.arccos(np.cos(np.deg2rad(df['OZA:float'])) *
-                                           np.cos(np.deg2rad(df['SZA:float'])) -
-                                           np.sin(np.deg2rad(df['OZA:float'])) *
-                                           np.sin(np.deg2rad(df['SZA:float'])) *
-                                           np.cos(np.deg2rad(abs(df['SAA:float'] - df['OAA:float'])))))
-        # excel version
-        # =GRAUS(ACOS(COS(RADIANOS(OZA))*COS(RADIANOS(SZA))-SEN(RADIANOS(OZA))*SEN(RADIANOS(SZA))*COS(RADIANOS(ABS(SAA-OAA)))))
+        df['GLINT'] = TsGenerator.glint_angle(df['OZA:float'], df['SZA:float'], df['SAA:float'], df['OAA:float'])
         return df
 
-    def add_flags_to_df(self, df):
+    @staticmethod
+    def glint_angle(oza, sza, saa, oaa):
         """
-        # TODO: Write docstrings.
+        Glint angle of get_glint, over arrays (or Series) of the observation and sun angles.
         """
-        df['FLAGS'] = df['WQSF_lsb:double'].apply(self.get_flags)
-        df['QUALITY'] = df['FLAGS'].apply(self.get_quality)
-        pass
-
-    def update_df(self, df, ir_min_threshold=False, ir_max_threshold=False,
-                  max_aot=False, cams_val=False, normalize=False):
-
-        # Delete indexes for which Oa01_reflectance is saturated:
-        indexNames = df[df['Oa01_reflectance:float'] == 1.0000184].index
-        df.drop(indexNames, inplace=True)
-
-        # This should represent 100% of the pixels inside the SHP area before applying the filters.
-        df['ABSVLDPX'] = len(df)
+        return np.degrees(np.arccos(np.cos(np.deg2rad(oza)) *
+                                    np.cos(np.deg2rad(sza)) -
+                                    np.sin(np.deg2rad(oza)) *
+                                    np.sin(np.deg2rad(sza)) *
+                                    np.cos(np.deg2rad(abs(saa - oaa)))))
+        # excel version
+        # =GRAUS(ACOS(COS(RADIANOS(OZA))*COS(RADIANOS(SZA))-SEN(RADIANOS(OZA))*SEN(RADIANOS(SZA))*COS(RADIANOS(ABS(SAA-OAA)))))
 
-        #####################################
-        # Normalization based on B21-1020nm #
-        #####################################
-        if normalize:
-            df = self._normalize(df, dd.wfr_norm_s3_bands, norm_band='Oa21_reflectance:float')
+    def add_flags_to_df(self, df, flags=True):
+        """
+        Add the QUALITY column: 1 where the WQSF value has every self.keep flag and none of self.remove
+        (bitwise over the whole column, see Utils.wqsf_quality), 0 otherwise.
+        If flags, also add the human-readable FLAGS column (get_flags is only called once per distinct WQSF value).
+        """
+        wqsf = df['WQSF_lsb:double'].to_numpy()
+        if flags:
+            values, inverse = np.unique(wqsf, return_inverse=True)
+            names = [self.get_flags(val) for val in values.tolist()]
+            df['FLAGS'] = pd.Series([names[i] for i in inverse.ravel()], index=df.index, dtype=object)
+        df['QUALITY'] = Utils.wqsf_quality(wqsf, keep=self.keep, remove=self.remove).astype(np.int64)
+
+    # Reflectances that must be positive (the others may be negative), see the nodata stage of update_df.
+    positive_bands = ['Oa06_reflectance:float',
+                      'Oa07_reflectance:float',
+                      'Oa08_reflectance:float',
+                      'Oa09_reflectance:float',
+                      'Oa10_reflectance:float',
+                      'Oa17_reflectance:float']
+
+    def filter_chain(self, columns, ir_min_threshold=False, ir_max_threshold=False, max_aot=False, cams_val=False):
+        """
+        Rules of update_df over a DataFrame with the given columns, as an ordered list of (stage name, predicate)
+        pairs. A predicate gets col(name), the values of a column at the rows that survived the previous stages, and
+        returns which of them to keep. Predicates also computing a derived column return (keep, {column name: values}).
+        """
+        stages = [('saturation', lambda col: col('Oa01_reflectance:float', raw=True) != dd.wfr_oa01_saturation)]
 
         # In case the reflectance of water pixels should not be below 0.001
         # in the NIR Band (Oa17:865nm), we will drop using the threshold:
         if ir_min_threshold:
-            indexNames = df[df['Oa17_reflectance:float'] < ir_min_threshold].index
-            # Delete these row indexes from dataFrame
-            df.drop(indexNames, inplace=True)
+            stages.append(('ir_min', lambda col: ~(col('Oa17_reflectance:float') < ir_min_threshold)))
 
         # Assuming that the reflectance of water pixels should not be above 0.2
         # in the NIR Band (Oa17:865nm), we will drop using the threshold:
         if ir_max_threshold:
-            indexNames = df[df['Oa17_reflectance:float'] > ir_max_threshold].index
-            # Delete these row indexes from dataFrame
-            df.drop(indexNames, inplace=True)
+            stages.append(('ir_max', lambda col: ~(col('Oa17_reflectance:float') > ir_max_threshold)))
 
-        ##############
-        # CAMS PROXY #
-        ##############
+        # CAMS PROXY: CAMS observations tend to be always bellow that of S3 AOT 865
+        # handle observations that does not follow this rule as outliers
         if cams_val:
-            # CAMS observations tend to be always bellow that of S3 AOT 865
-            # handle observations that does not follow this rule as outliers
-            df = df[df['T865:float'] > cams_val]
-
-        # Add new FLAGS and QUALITY cols
-        self.add_flags_to_df(df)
-
-        # Delete indexes for which QUALITY = 0
-        indexNames = df[df['QUALITY'] == 0].index
-        df.drop(indexNames, inplace=True)
-
-        # Delete indexes for which FLAGS = False
-        indexNames = df[df['FLAGS'] == False].index  # TODO: verify why the use of 'is' instead of '==' breaks the code.
-        df.drop(indexNames, inplace=True)
-
-        if max_aot:  # 0.6
-            # Delete the indexes for which T865 (Aerosol optical depth) is thicker than 0.6
-            indexNames = df[df['T865:float'] >= max_aot].index
-            df.drop(indexNames, inplace=True)
-
-        ################################
-        # FILTER NEGATIVE REFLECTANCES #
-        ################################
-        # df.loc[df['Oa01_reflectance:float'] < 0, 'Oa01_reflectance:float'] = np.nan
-        # df.loc[df['Oa02_reflectance:float'] < 0, 'Oa02_reflectance:float'] = np.nan
-        # df.loc[df['Oa03_reflectance:float'] < 0, 'Oa03_reflectance:float'] = np.nan
-        # df.loc[df['Oa04_reflectance:float'] < 0, 'Oa04_reflectance:float'] = np.nan
-        # df.loc[df['Oa05_reflectance:float'] < 0, 'Oa05_reflectance:float'] = np.nan
-        df.loc[df['Oa06_reflectance:float'] <= 0, 'Oa06_reflectance:float'] = np.nan
-        df.loc[df['Oa07_reflectance:float'] <= 0, 'Oa07_reflectance:float'] = np.nan
-        df.loc[df['Oa08_reflectance:float'] <= 0, 'Oa08_reflectance:float'] = np.nan
-        df.loc[df['Oa09_reflectance:float'] <= 0, 'Oa09_reflectance:float'] = np.nan
-        df.loc[df['Oa10_reflectance:float'] <= 0, 'Oa10_reflectance:float'] = np.nan
-        # df.loc[df['Oa11_reflectance:float'] < 0, 'Oa11_reflectance:float'] = np.nan
-        # df.loc[df['Oa12_reflectance:float'] < 0, 'Oa12_reflectance:float'] = np.nan
-        # df.loc[df['Oa16_reflectance:float'] < 0, 'Oa16_reflectance:float'] = np.nan
-        df.loc[df['Oa17_reflectance:float'] <= 0, 'Oa17_reflectance:float'] = np.nan
-        # df.loc[df['Oa18_reflectance:float'] < 0, 'Oa18_reflectance:float'] = np.nan
-        # df.loc[df['Oa21_reflectance:float'] < 0, 'Oa21_reflectance:float'] = np.nan
-
-        ###############################
-        # DROP EVERY NAN REFLECTANCES #
-        ###############################
-        df.dropna(inplace=True)
-
-        #####################
-        # CURVE SHAPE RULES #
-        #####################
-        # Oa16 must always be above Oa12, for Oa12 is an atmospheric attenuation window
-        # df = df[df['Oa16_reflectance:float'] > df['Oa12_reflectance:float']]
-
-        # Oa11 must always be higher than Oa12
-        df = df[df['Oa11_reflectance:float'] > df['Oa12_reflectance:float']].copy()
-
-        ##########################
-        # Calculate GLINT for DF #
-        ##########################
-        df = self.get_glint(df)
-        row_idx = df[df['GLINT'] <= self.glint].index
-        df.drop(row_idx, inplace=True)
-
-        ##########################
-        # Add MNDWI / NDWI Index #
-        ##########################
-        self.calc_nd_index(df, 'Oa06_reflectance:float', 'Oa21_reflectance:float', column_name='MNDWI')  # Green / SWIR
-        self.calc_nd_index(df, 'Oa06_reflectance:float', 'Oa17_reflectance:float', column_name='NDWI')  # Green / IR
-        valid_mndwi = (df['MNDWI'] > -0.99) & (df['MNDWI'] < 0.99)
-        valid_ndwi = (df['NDWI'] > -0.99) & (df['NDWI'] < 0.99)
-        df = df[valid_mndwi & valid_ndwi]
+            stages.append(('cams', lambda col: col('T865:float') > cams_val))
+
+        # WQSF flags, see add_flags_to_df
+        stages.append(('quality', lambda col: Utils.wqsf_quality(col('WQSF_lsb:double'),
+                                                                 keep=self.keep, remove=self.remove)))
+
+        # Delete the indexes for which T865 (Aerosol optical depth) is thicker than max_aot (0.6)
+        if max_aot:
+            stages.append(('max_aot', lambda col: ~(col('T865:float') >= max_aot)))
+
+        stages += [('nodata', lambda col: self._no_nan_reflectance(col, columns)),
+                   # Oa11 must always be higher than Oa12
+                   ('curve_shape', lambda col: col('Oa11_reflectance:float') > col('Oa12_reflectance:float')),
+                   ('glint', self._glint_filter),
+                   ('water_index', self._water_index_filter)]
+        return stages
+
+    def _no_nan_reflectance(self, col, columns):
+        # Non-positive reflectances of positive_bands are NaN, and no column of the pixel may be NaN
+        keep = col(self.positive_bands[0]) > 0
+        for band in self.positive_bands[1:]:
+            keep &= col(band) > 0
+        for name in columns:
+            keep &= ~pd.isna(col(name))
+        return keep
+
+    def _glint_filter(self, col):
+        glint = self.glint_angle(col('OZA:float'), col('SZA:float'), col('SAA:float'), col('OAA:float'))
+        return ~(glint <= self.glint), {'GLINT': glint}
+
+    @staticmethod
+    def _water_index_filter(col):
+        mndwi = TsGenerator.nd_index(col('Oa06_reflectance:float'), col('Oa21_reflectance:float'))  # Green / SWIR
+        ndwi = TsGenerator.nd_index(col('Oa06_reflectance:float'), col('Oa17_reflectance:float'))  # Green / IR
+        keep = (mndwi > -0.99) & (mndwi < 0.99) & (ndwi > -0.99) & (ndwi < 0.99)
+        return keep, {'MNDWI': mndwi, 'NDWI': ndwi}
+
+    def update_df(self, df, ir_min_threshold=False, ir_max_threshold=False,
+                  max_aot=False, cams_val=False, normalize=False, flags=False):
+        """
+        Apply the rules of filter_chain to the pixels of df and add the ABSVLDPX, QUALITY (and FLAGS, if asked for),
+        GLINT, MNDWI, NDWI and SPM columns.
+        Every rule only looks at the rows that survived the previous ones and df is only subset once, at the end,
+        so the derived columns are only computed for the surviving rows.
+        """
+        rows = np.arange(len(df))  # positions of the surviving rows
+        norm_bands = set(dd.wfr_norm_s3_bands) if normalize else set()
+
+        def col(name, raw=False):
+            # Normalization based on B21-1020nm, only for the surviving rows
+            values = df[name].to_numpy()[rows]
+            if name in norm_bands and not raw:
+                values = values - df['Oa21_reflectance:float'].to_numpy()[rows]
+            return values
+
+        derived = {}
+        absvldpx = None
+        self.last_funnel = []
+        for stage, predicate in self.filter_chain(list(df.columns), ir_min_threshold, ir_max_threshold,
+                                                   max_aot, cams_val):
+            t1 = time.perf_counter()
+            pixels_in = len(rows)
+            keep = predicate(col)
+            if isinstance(keep, tuple):
+                keep, columns = keep
+                derived.update({name: (rows, values) for name, values in columns.items()})
+            rows = rows[np.asarray(keep, dtype=bool)]
+            self._funnel_record(stage, pixels_in, len(rows), t1)
+            if stage == 'saturation':
+                # This should represent 100% of the pixels inside the SHP area before applying the filters.
+                absvldpx = len(rows)
+
+        t1 = time.perf_counter()
+
+        df = df.iloc[rows]
+        if normalize:
+            df = self._normalize(df, dd.wfr_norm_s3_bands, norm_band='Oa21_reflectance:float')
+        else:
+            df = df.copy()
+
+        # Extractions with push-down (see ParallelBandExtract.nc_2_batch) already counted them before dropping flags.
+        if 'ABSVLDPX' not in df:
+            df['ABSVLDPX'] = absvldpx
+
+        # Add new QUALITY col (and FLAGS, only if asked for)
+        self.add_flags_to_df(df, flags=flags)
+
+        # Derived columns, computed by their stage over a superset of the surviving rows
+        for name, (at_rows, values) in derived.items():
+            df[name] = values[np.isin(at_rows, rows)]
 
         ###########
         # Get SPM #
@@ -268,18 +302,37 @@ class TsGenerator:
         # Fix the indexing of the dataframe #
         #####################################
         df.reset_index(drop=True, inplace=True)
+        self._funnel_record('derived_columns', len(rows), len(df), t1)
 
         return df
 
+    def _funnel_record(self, stage, pixels_in, pixels_out, t1):
+        self.last_funnel.append({'stage': stage,
+                                 'pixels_in': pixels_in,
+                                 'pixels_out': pixels_out,
+                                 'dropped': pixels_in - pixels_out,
+                                 'seconds': time.perf_counter() - t1})
+
+    def add_funnel_stage(self, product, stage, pixels_in, pixels_out, t1):
+        """
+        Record a filter applied outside of update_df (e.g. the DBSCAN clustering) to the funnel of product,
+        t1 being the time.perf_counter() of its start.
+        """
+        self._funnel_record(stage, pixels_in, pixels_out, t1)
+        self.funnel.append(dict(product=product, **self.last_funnel.pop()))
+
     def update_csvs(self, csv_path, glint=20.0, savepath=False,
                     ir_min_threshold=False,
                     ir_max_threshold=False,
                     max_aot=False,
                     GPT=False,
                     cams_val=False,
-                    normalize=False):
+                    normalize=False,
+                    raw_df=None,
+                    flags=False):
         """
         Given an CSV of pixels extracted using SEN3R or GPT(SNAP), filter the dataset and add some new columns.
+        SEN3R pixel files can also be Parquet (see Utils.write_pixels), the output keeps the format of the input.
 
         Input:
             csv_path (string): complete path to the CSV to be updated.
@@ -290,31 +343,48 @@ class TsGenerator:
 
             When savepath is not given, the new DF will no be saved, but it will still be returned.
 
+            raw_df (pandas dataframe): csv_path already in memory, it is then not read again (and is modified).
+
+            flags (bool): also keep the human-readable FLAGS column of each pixel.
+
         Output:
             df (pandas dataframe): in-memory version of the input data that was read and modified from csv_path.
         """
         # read text file and convert to pandas dataframe
-        if GPT:
+        if raw_df is None and GPT:
             raw_df = pd.read_csv(csv_path, sep='\t', skiprows=1)
-        else:
-            raw_df = pd.read_csv(csv_path, sep=',')
+        elif raw_df is None:
+            raw_df = Utils.read_pixels(csv_path)
 
         self.glint = glint
         df = self.update_df(df=raw_df,
                             ir_min_threshold=ir_min_threshold,
                             ir_max_threshold=ir_max_threshold,
                             max_aot=max_aot,
-                            cams_val=cams_val)
+                            cams_val=cams_val,
+                            flags=flags)
+
+        # Funnel of the stages of update_df, kept for the whole run (see funnel_table)
+        product = os.path.basename(csv_path)
+        self.funnel += [dict(product=product, **record) for record in self.last_funnel]
 
         if savepath:
             full_saving_path = os.path.join(savepath, os.path.basename(csv_path))
             print(f'Saving dataset: {full_saving_path}')
-            df.to_csv(full_saving_path)
+            Utils.write_pixels(df, full_saving_path, index=True)
             return full_saving_path, df
 
         else:
             return 'unsaved', df
 
+    def funnel_table(self):
+        """
+        DataFrame of the funnel records of every product processed by update_csvs: one row per product and stage of
+        update_df (see filter_chain) with the pixels in, out and dropped and the elapsed seconds.
+        """
+        columns = ['product', 'stage', 'pixels_in', 'pixels_out', 'dropped', 'seconds']
+        return pd.DataFrame(self.funnel, columns=columns)
+
     @staticmethod
     def kde_local_maxima(x):
         """
@@ -337,9 +407,6 @@ class TsGenerator:
         """
         # TODO: Write docstrings.
         """
-        # read text file and convert to pandas dataframe
-        df = pd.read_csv(image_path)
-
         # Columns to keep
         keep = ['Oa01_reflectance:float',
                 'Oa02_reflectance:float',
@@ -369,6 +436,9 @@ class TsGenerator:
                 'ABSVLDPX',
                 'TSM_NN']
 
+        # read only the kept columns of the pixels file and convert to pandas dataframe
+        df = Utils.read_pixels(image_path, columns=keep)
+
         # Drop columns not present in the list
         df = df.filter(keep)
 
@@ -481,10 +551,12 @@ class TsGenerator:
 
         return sorted_s3frbr_output_files
 
-    def generate_tms_data(self, work_dir, sorted_list):
+    def generate_tms_data(self, work_dir, sorted_list, skipped=None):
         """
         # TODO: Write docstrings.
+        skipped: optional dict {file name: reason} of the products left out by the extraction (see Core.extract_product).
         """
+        skipped = skipped or {}
         Oa01_reflectance_tms = []
         Oa02_reflectance_tms = []
         Oa03_reflectance_tms = []
@@ -552,7 +624,7 @@ class TsGenerator:
 
             if means_dict['AbsVldPx'] == 0:
                 quality = 0
-                qobs = 'Empty DataFrame, processing skipped.'
+                qobs = skipped.get(image, 'Empty DataFrame, processing skipped.')
             elif means_dict['VldPx.pct'] < 5.0:
                 quality = 2
                 qobs = 'Less than 5% of valid pixels.'